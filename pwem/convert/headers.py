@@ -31,21 +31,33 @@ TODO:
 """
 
 import collections
+import os
+import shutil
 import struct
 from math import isnan
 
+import numpy
+
 from pyworkflow.utils import getExt
 from ..emlib.image import ImageHandler
+from ..emlib.image.image_handler import MRC_MODES
 
 # File formats
 MRC = 0
 SPIDER = 1
 UNKNOWNFORMAT = 2
 
+# Size in bytes of the main MRC header
+MRC_HEADER_SIZE = 1024
+
 
 class Ccp4Header:
     ORIGIN = 0  # save coordinate origin in the mrc header field=Origin (Angstrom)
     START = 1  # save coordinate origin in the mrc header field=start (pixel)
+    # Layout of the header words 1 to 52
+    chain = "< 3i i 3i 3i 3f 36s i 104s 3f"
+    # Layout of the header words 53 to 56 (MAP, MACHST, ARMS, NLABL)
+    tailChain = "< 4s 4s f i"
 
     """
     In spite of the name this is the MRC2014 format no the CCP4.
@@ -119,7 +131,6 @@ class Ccp4Header:
     def __init__(self, fileName, readHeader=False):
         self.isMovie = False
         self._header = collections.OrderedDict()
-        self.chain = "< 3i i 3i 3i 3f 36s i 104s 3f"
         self._name = self.cleanFileNameAnnotation(fileName)
         if readHeader:
             self.loaded = True
@@ -170,6 +181,18 @@ class Ccp4Header:
     def setMode(self, mode):
         self._header['Mode'] = mode
 
+    def getMode(self):
+        return self._header['Mode']
+
+    def getExtendedHeaderSize(self):
+        """ Return the number of bytes (NSYMBT) stored between the
+        1024 bytes header and the data block. """
+        return struct.unpack('<i', self._header['dummy2'][:4])[0]
+
+    def getDataOffset(self):
+        """ Return the byte offset where the image data starts. """
+        return MRC_HEADER_SIZE + self.getExtendedHeaderSize()
+
     def setStartPixel(self, originTransformShift):  # PIXEL
         """input pixels"""
         self._header['originX'] = 0.  # originTransformShift[0]
@@ -252,6 +275,10 @@ class Ccp4Header:
         f = open(self._name, 'rb')
         s = f.read(52 * 4)  # read header from word 0 to 51
         f.close()
+        self.unpackHeader(s)
+
+    def unpackHeader(self, s):
+        """ Fill the header from the bytes of words 0 to 51. """
         a = struct.unpack(self.chain, s)
 
         # fill dicionary
@@ -281,10 +308,14 @@ class Ccp4Header:
     def setHeader(self, newHeader):
         self._header = newHeader
 
-    def writeHeader(self):
+    def packHeader(self):
+        """ Return the bytes of words 0 to 51 of the header. """
         ss = struct.Struct(self.chain)
         t = tuple(self._header.values())
-        packed_data = ss.pack(*t)
+        return ss.pack(*t)
+
+    def writeHeader(self):
+        packed_data = self.packHeader()
 
         # Python 3 will fail writing bytes in a text file unless it's open
         # as rb or wb for reading and writing binaries, respectively.
@@ -331,13 +362,49 @@ class Ccp4Header:
 
         return fileName
 
+    def getAxisOrder(self):
+        """ Return the (MAPC, MAPR, MAPS) axis order of the map. """
+        return struct.unpack('< 3i', self._header['dummy1'][12:24])
+
+    @classmethod
+    def isPlainMrc(cls, fileName):
+        """ Return True if fileName is a little endian MRC file, with
+        standard axis order, a mode handled by ImageHandler and a
+        complete data block. The data of these files can be reused as
+        it is and only their header needs to be modified.
+        """
+        ccp4header = Ccp4Header(fileName)
+        fn = ccp4header._name
+        if getFileFormat(fn) != MRC or not os.path.exists(fn):
+            return False
+        fileSize = os.path.getsize(fn)
+        if fileSize < MRC_HEADER_SIZE:
+            return False
+
+        ccp4header.readHeader()
+        mode = ccp4header.getMode()
+        if mode not in MRC_MODES or ccp4header.getAxisOrder() != (1, 2, 3):
+            return False
+        x, y, z = ccp4header.getDims()
+        dataSize = x * y * z * numpy.dtype(MRC_MODES[mode]).itemsize
+        return min(x, y, z) > 0 and fileSize >= ccp4header.getDataOffset() + dataSize
+
     @classmethod
     def fixFile(cls, inFileName, outFileName, scipionOriginShifts,
-                sampling=1.0, originField=START):
+                sampling=1.0, originField=START, headerOnly=True):
         """ Create new CCP4 binary file and fix its header.
+        If headerOnly is True and the input is already a plain MRC
+        volume (see isPlainMrc), the file is copied and only its header
+        is patched, instead of converting the whole volume.
         """
-        ImageHandler().convert(inFileName, outFileName)
         x, y, z, ndim = ImageHandler().getDimensions(inFileName)
+        if headerOnly and ndim == 1 and cls.isPlainMrc(inFileName):
+            inFn = Ccp4Header(inFileName)._name
+            outFn = Ccp4Header(outFileName)._name
+            if os.path.abspath(inFn) != os.path.abspath(outFn):
+                shutil.copyfile(inFn, outFn)
+        else:
+            ImageHandler().convert(inFileName, outFileName)
         ccp4header = Ccp4Header(outFileName, readHeader=True)
         ccp4header.setGridSampling(x, y, z)
         ccp4header.setCellDimensions(x * sampling, y * sampling, z * sampling)
@@ -362,29 +429,61 @@ def getFileFormat(fileName):
     else:
         return UNKNOWNFORMAT
 
-def fixVolume(paths):
+def editMRCHeaders(paths, samplingRate=None, origin=None, gridSampling=None,
+                   mode=None, ispg=None):
     """
-    Fixes mrc (any extension) files that are defined as stacks but are meant to be volumes as defined in the mrc 2014
-    specs. Setting ISPG to 1.
+    Edits the header of many mrc (any extension) files. Each file is opened
+    once and only its header is read and, if any field changes, written.
     :param paths: accept a string or a list of strings
-    :return: nothing, but mrc files header end up being updated.
+    :param samplingRate: sampling rate (A/px) used to set the cell dimensions
+    :param origin: (x, y, z) origin in Angstroms (see Ccp4Header.setOrigin)
+    :param gridSampling: (mx, my, mz) grid sampling. Applied before the sampling rate
+    :param mode: data type of the file. Only the header field is changed, not the data
+    :param ispg: space group (1 for volumes, 0 for stacks of images)
+    :return: list of paths whose header was already up to date (not written)
     """
     if isinstance(paths, str):
         paths = [paths]
+    unchanged = []
     for path in paths:
-        ccp4header = Ccp4Header(path, readHeader=True)
-        ccp4header.setISPG(1)
-        ccp4header.writeHeader()
+        ccp4header = Ccp4Header(path)
+        with open(ccp4header._name, 'rb+') as f:
+            headerBytes = f.read(struct.calcsize(Ccp4Header.chain))
+            ccp4header.unpackHeader(headerBytes)
+            if gridSampling is not None:
+                ccp4header.setGridSampling(*gridSampling)
+            if samplingRate is not None:
+                ccp4header.setSampling(samplingRate)
+            if origin is not None:
+                ccp4header.setOrigin(origin)
+            if mode is not None:
+                ccp4header.setMode(mode)
+            if ispg is not None:
+                ccp4header.setISPG(ispg)
+
+            newBytes = ccp4header.packHeader()
+            if newBytes == headerBytes:
+                unchanged.append(path)
+            else:
+                f.seek(0)
+                f.write(newBytes)
+    return unchanged
+
+
+def fixVolume(paths):
+    """
+    Fixes mrc (any extension) files that are defined as stacks but are meant to be volumes as defined in the mrc 2014
+    specs. Setting ISPG to 1.
+    :param paths: accept a string or a list of strings
+    :return: list of paths that were already volumes (not written)
+    """
+    return editMRCHeaders(paths, ispg=1)
+
 
 def setMRCSamplingRate(paths, samplingRate):
     """
     Sets the mrc file sampling rate value
     :param paths: accept a string or a list of strings
-    :return: nothing, but mrc files header end up being updated with the right sampling rate
+    :return: list of paths that already had the right sampling rate (not written)
     """
-    if isinstance(paths, str):
-        paths = [paths]
-    for path in paths:
-        ccp4header = Ccp4Header(path, readHeader=True)
-        ccp4header.setSampling(samplingRate)
-        ccp4header.writeHeader()
+    return editMRCHeaders(paths, samplingRate=samplingRate)
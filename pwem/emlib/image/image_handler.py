@@ -25,6 +25,7 @@
 # **************************************************************************
 
 import os
+import struct
 
 import numpy
 from PIL import Image
@@ -35,11 +36,194 @@ import pwem.objects as emobj
 import pwem.constants as emcts
 from .. import lib
 
+# Numpy types for the MRC modes handled by the native MRC backend
+MRC_MODES = {
+    0: numpy.int8,
+    1: numpy.int16,
+    2: numpy.float32,
+    4: numpy.complex64,
+    6: numpy.uint16,
+    12: numpy.float16
+}
+
+# Space group value used to flag volumes (1) and stacks of volumes (401)
+MRC_ISPG_VOLUME = 1
+MRC_ISPG_VOLUME_STACK = 401
+
+
+def _getMrcMode(dtype):
+    """ Return the (mode, dtype) pair used to store data of the
+    given numpy dtype in an MRC file. """
+    dtype = numpy.dtype(dtype)
+    for mode, mrcType in MRC_MODES.items():
+        if dtype == mrcType:
+            return mode, dtype
+    if dtype.kind == 'c':
+        return 4, numpy.dtype(numpy.complex64)
+    if dtype == numpy.uint8 or dtype == numpy.bool_:
+        return 6, numpy.dtype(numpy.uint16)
+    return 2, numpy.dtype(numpy.float32)
+
+
+class MrcImage(object):
+    """ Numpy based image read from (or to be written to) an MRC file.
+    It mimics the subset of the xmipp Image API used in Scipion, so it
+    can be used when xmippLib is not available. Data read from disk is
+    memory-mapped (copy-on-write), so only the touched slices are read.
+    """
+    def __init__(self, location=None):
+        self._data = None
+        self._sampling = 1.0
+        self._origin = (0., 0., 0.)
+        if location is not None:
+            self.read(location)
+
+    def read(self, location, *args):
+        index, fn = ImageHandler._convertToLocation(location)
+        header, data = ImageHandler._openMrc(fn, mode='c')
+        self._data = ImageHandler._getMrcItem(header, data, index, fn)
+        # Keep the header geometry to write it back
+        self._sampling = ImageHandler._getMrcSampling(header)
+        self._origin = header.getOrigin()
+
+    def write(self, location):
+        ImageHandler.writeMrc(self._data, location, self._sampling,
+                              self._origin)
+
+    def getData(self):
+        return self._data
+
+    def setData(self, data):
+        self._data = data
+
+    def getDataType(self):
+        return self._data.dtype
+
+    def convert2DataType(self, dataType):
+        self._data = self._data.astype(ImageHandler.getNumpyDataType(dataType))
+
+    def getDimensions(self):
+        shape = self._data.shape
+        if len(shape) == 2:
+            return shape[1], shape[0], 1, 1
+        if len(shape) == 3:
+            return shape[2], shape[1], shape[0], 1
+        return shape[3], shape[2], shape[1], shape[0]
+
+    def _getOperand(self, other):
+        return other.getData() if isinstance(other, MrcImage) else other
+
+    def inplaceAdd(self, other):
+        self._data = self._data + self._getOperand(other)
+
+    def inplaceSubtract(self, other):
+        self._data = self._data - self._getOperand(other)
+
+    def inplaceMultiply(self, other):
+        self._data = self._data * self._getOperand(other)
+
+    def inplaceDivide(self, other):
+        self._data = self._data / self._getOperand(other)
+
+
+class MrcStackWriter(object):
+    """ Write a stack of images in a single pass. The output file is
+    allocated once with its final header (when the first image is
+    written) and the images are written in order through a single open
+    file handle. It can be used as a context manager:
+
+        with ImageHandler.createStackWriter('stack.mrcs', n) as writer:
+            for data in ...:
+                writer.append(data)
+    """
+    def __init__(self, fnStack, n, sampling=1.0):
+        self._fn = ImageHandler.removeFileType(fnStack)
+        self._n = n
+        self._sampling = sampling
+        self._file = None
+        self._count = 0
+        self._shape = None
+        self._dtype = None
+        # min, max, sum, sum of squares
+        self._stats = [None, None, 0., 0.]
+
+    def _allocate(self, data):
+        """ Create the output file with the final header and size. """
+        # Local import to avoid import loop between ImageHandler and Ccp4Header.
+        from pwem.convert import headers
+
+        self._shape = (1,) + data.shape if data.ndim == 2 else data.shape
+        _, dtype = _getMrcMode(data.dtype)
+        self._dtype = dtype.newbyteorder('<')
+        ImageHandler._writeMrcHeader(self._fn, (self._n,) + self._shape,
+                                     self._dtype, data.ndim == 2, self._sampling)
+        self._file = open(self._fn, 'rb+')
+        self._file.truncate(headers.MRC_HEADER_SIZE +
+                            self._n * data.size * self._dtype.itemsize)
+        self._file.seek(headers.MRC_HEADER_SIZE)
+
+    def append(self, data):
+        """ Write the next image of the stack. """
+        data = numpy.asarray(data)
+        self.extend(data.reshape((1,) + data.shape))
+
+    def extend(self, block):
+        """ Write the next images of the stack from a block of images
+        (an array whose first dimension is the number of images). """
+        block = numpy.asarray(block)
+        if self._file is None:
+            self._allocate(block[0])
+        count = block.shape[0]
+        if self._count + count > self._n:
+            raise IndexError("Stack %s can not hold more than %d images"
+                             % (self._fn, self._n))
+        data = block.reshape((count,) + self._shape).astype(self._dtype,
+                                                            copy=False)
+        if not numpy.iscomplexobj(data):
+            dataMin, dataMax = float(data.min()), float(data.max())
+            stats = self._stats
+            stats[0] = dataMin if stats[0] is None else min(stats[0], dataMin)
+            stats[1] = dataMax if stats[1] is None else max(stats[1], dataMax)
+            stats[2] += float(data.sum(dtype=numpy.float64))
+            stats[3] += float(numpy.square(data, dtype=numpy.float64).sum())
+        self._file.write(data.tobytes())
+        self._count += count
+
+    def close(self):
+        """ Close the output file, updating the header statistics. """
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        size = self._count * int(numpy.prod(self._shape))
+        if size and self._stats[0] is not None:
+            mean = self._stats[2] / size
+            rms = max(self._stats[3] / size - mean * mean, 0.) ** 0.5
+            ImageHandler._writeMrcHeader(self._fn, (self._n,) + self._shape,
+                                         self._dtype, self._shape[0] == 1,
+                                         self._sampling,
+                                         (self._stats[0], self._stats[1], mean),
+                                         rms, mode='rb+')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
 class ImageHandler(object):
     """ Class to provide several Image manipulation utilities. """
 
     # TODO: remove dependency from Xmipp
 
+    # Binning methods used to compute thumbnails
+    SHRINK_FOURIER = 'fouriershrink'
+    SHRINK_MEAN = 'meanshrink'
+
+    # Dimensions of tiff files: {path: ((mtime, size), (x, y, z, n))}
+    _tiffDimsCache = {}
+
     def __init__(self):
         # Now it will use Xmipp image library
         # to read and write most of formats, in the future
@@ -47,6 +231,8 @@ class ImageHandler(object):
         # our own image library
         self._img = lib.Image()
         self._imgClass = lib.Image
+        # (filename, header, memmap) of the last MRC file used in readData
+        self._lastMrc = None
 
     @classmethod
     def fixXmippVolumeFileName(cls, image):
@@ -159,6 +345,17 @@ class ImageHandler(object):
                                                    'convertImage',
                                                    doRaise=True)
             convertImage(inputLoc, outputLoc)
+        elif (transform is None and self.isMrcLocation(inputLoc)
+              and self.isMrcLocation(outputLoc)):
+            # MRC to MRC conversions do not need to decode the whole
+            # input file, only the requested image is read from disk
+            index, fn = inputLoc
+            header, data = self._openMrc(fn)
+            data = self._getMrcItem(header, data, index, fn)
+            if dataType is not None:
+                data = data.astype(self.getNumpyDataType(dataType))
+            self.writeMrc(data, outputLoc, self._getMrcSampling(header),
+                          header.getOrigin())
         else:
             # Read from input
             self._img.read(inputLoc)
@@ -258,17 +455,66 @@ class ImageHandler(object):
                     doRaise=True)
                 return getImageDimensions(fn)  # we are ignoring index here
             elif ext in ['.eer', '.gain', '.tif', '.tiff']:
-                tif = TiffFile(fn)
-                frames = len(tif.pages)  # number of pages in the file
-                page = tif.pages[0]  # get shape and dtype of the image in the first page
-                x, y = page.shape
-                return x, y, frames, 1
+                return self.getTiffDimensions(fn)
             else:
                 self._img.read(location, lib.HEADER)
                 return self._img.getDimensions()
         else:
             return None, None, None, None
 
+    @classmethod
+    def getTiffDimensions(cls, fn):
+        """ Return the (x, y, frames, 1) dimensions of a tiff file
+        (.tif, .eer, .gain). Only the first page is parsed and the rest
+        of the frames are counted walking the IFD offsets. Results are
+        cached while the file modification time and size do not change.
+        """
+        stat = os.stat(fn)
+        fileKey = (stat.st_mtime, stat.st_size)
+        cached = cls._tiffDimsCache.get(fn)
+
+        if cached is None or cached[0] != fileKey:
+            with TiffFile(fn) as tif:
+                page = tif.pages[0]  # get shape and dtype of the image in the first page
+                x, y = page.shape[:2]
+            frames = cls._countTiffPages(fn)
+            cached = (fileKey, (x, y, frames, 1))
+            cls._tiffDimsCache[fn] = cached
+
+        return cached[1]
+
+    @staticmethod
+    def _countTiffPages(fn):
+        """ Count the pages of a tiff file (classic or BigTIFF) reading
+        only the number of tags and the next offset of each IFD.
+        """
+        with open(fn, 'rb') as f:
+            order = '<' if f.read(2) == b'II' else '>'
+            version = struct.unpack(order + 'H', f.read(2))[0]
+            if version == 43:  # BigTIFF
+                f.seek(8)
+                countFmt, tagSize, offsetFmt = 'Q', 20, 'Q'
+            else:
+                countFmt, tagSize, offsetFmt = 'H', 12, 'I'
+            countSize = struct.calcsize(countFmt)
+            offsetSize = struct.calcsize(offsetFmt)
+
+            offset = struct.unpack(order + offsetFmt, f.read(offsetSize))[0]
+            pages = 0
+            visited = set()
+            while offset and offset not in visited:
+                visited.add(offset)
+                pages += 1
+                f.seek(offset)
+                tags = struct.unpack(order + countFmt, f.read(countSize))[0]
+                f.seek(offset + countSize + tags * tagSize)
+                offsetBytes = f.read(offsetSize)
+                if len(offsetBytes) < offsetSize:
+                    break
+                offset = struct.unpack(order + offsetFmt, offsetBytes)[0]
+
+        return pages
+
     def getDataType(self, locationObj):
         if self.existsLocation(locationObj):
             location = self._convertToLocation(locationObj)
@@ -282,8 +528,244 @@ class ImageHandler(object):
         (inputObj can be tuple, str or Image subclass). """
         location = self._convertToLocation(inputObj)
 
+        # Without xmippLib, MRC files are still readable with numpy
+        if getattr(lib, 'GHOST_ACTIVATED', False) and self.isMrcLocation(location):
+            return MrcImage(location)
+
         return self._imgClass(location)
 
+    @classmethod
+    def isMrcLocation(cls, locationObj):
+        """ Return True if the location is an MRC file that can be handled
+        by the native numpy backend (see readMrc and writeMrc).
+        Existing files with a mode not in MRC_MODES are not supported.
+        """
+        # Local import to avoid import loop between ImageHandler and Ccp4Header.
+        from pwem.convert import headers
+
+        _, fn = cls._convertToLocation(locationObj)
+        if headers.getFileFormat(fn) != headers.MRC:
+            return False
+
+        fn = cls.removeFileType(fn)
+        if os.path.exists(fn) and os.path.getsize(fn) >= headers.MRC_HEADER_SIZE:
+            header = headers.Ccp4Header(fn, readHeader=True)
+            return header.getMode() in MRC_MODES
+
+        return True
+
+    @classmethod
+    def getNumpyDataType(cls, dataType):
+        """ Return the numpy dtype for a given Xmipp data type
+        (DT_FLOAT, DT_SHORT...). Numpy types are returned unchanged. """
+        dtMap = {
+            'DT_UCHAR': numpy.uint8,
+            'DT_SCHAR': numpy.int8,
+            'DT_USHORT': numpy.uint16,
+            'DT_SHORT': numpy.int16,
+            'DT_UINT': numpy.uint32,
+            'DT_INT': numpy.int32,
+            'DT_FLOAT': numpy.float32,
+            'DT_DOUBLE': numpy.float64,
+            'DT_COMPLEXFLOAT': numpy.complex64,
+            'DT_COMPLEXDOUBLE': numpy.complex128
+        }
+        for label, npType in dtMap.items():
+            libType = getattr(lib, label, None)
+            if libType is not None and dataType == libType:
+                return numpy.dtype(npType)
+
+        return numpy.dtype(dataType)
+
+    @classmethod
+    def _openMrc(cls, fn, mode='r'):
+        """ Memory-map an MRC file. Returns the Ccp4Header and a numpy
+        memmap with shape (n, z, y, x), following the same dimensions
+        convention of Ccp4Header.getXYZN (file annotations like :mrc or
+        :mrcs are taken into account).
+        """
+        # Local import to avoid import loop between ImageHandler and Ccp4Header.
+        from pwem.convert import headers
+
+        header = headers.Ccp4Header(fn, readHeader=True)
+        x, y, z, n = header.getXYZN()
+        dtype = numpy.dtype(MRC_MODES[header.getMode()])
+        data = numpy.memmap(cls.removeFileType(fn), dtype=dtype.newbyteorder('<'),
+                            mode=mode, offset=header.getDataOffset(),
+                            shape=(n, z, y, x))
+        return header, data
+
+    @classmethod
+    def readMrc(cls, locationObj, mode='r'):
+        """ Return a numpy array (memory-mapped from disk) with the data
+        of an MRC location. Only the slices that are accessed are read.
+        Shape is (y, x) for single images, (z, y, x) for volumes and
+        (n, z, y, x) for stacks (as returned by xmipp Image.getData).
+        Params:
+            locationObj: tuple, string or Image subclass (see _convertToLocation)
+            mode: numpy.memmap mode, 'r' (read-only), 'r+' (read and write
+                to disk) or 'c' (copy-on-write, changes are not saved).
+        """
+        index, fn = cls._convertToLocation(locationObj)
+        header, data = cls._openMrc(fn, mode)
+        return cls._getMrcItem(header, data, index, fn)
+
+    @classmethod
+    def _getMrcItem(cls, header, data, index, fn):
+        """ Select the item at index from the (n, z, y, x) memmap of an
+        MRC file (see readMrc). """
+        n, z, y, x = data.shape
+
+        if index == emcts.NO_INDEX:
+            if n > 1:
+                return data
+            return data[0, 0] if z == 1 else data[0]
+
+        # An index in a file seen as a single volume refers to its sections
+        if n == 1 and z > 1 and header.getISPG() != MRC_ISPG_VOLUME_STACK:
+            data = data.reshape((z, 1, y, x))
+
+        if index < 1 or index > data.shape[0]:
+            raise IndexError("Index %d out of range (1-%d) in %s"
+                             % (index, data.shape[0], fn))
+        item = data[index - 1]
+        return item[0] if item.shape[0] == 1 else item
+
+    @classmethod
+    def _getMrcSampling(cls, header):
+        """ Return the pixel size (A/px) stored in an MRC header, 1.0 if
+        it is not set. """
+        x = header.getGridSampling()[0]
+        sampling = header.getCellDimensions()[0] / x if x else 0.
+        return sampling if sampling > 0 else 1.0
+
+    @classmethod
+    def _writeMrcHeader(cls, fn, shape, dtype, isStack, sampling=1.0,
+                        stats=(0., 0., 0.), rms=0., mode='wb',
+                        origin=(0., 0., 0.)):
+        """ Write a new MRC2014 header for data with shape (n, z, y, x).
+        Params:
+            origin: (x, y, z) origin in Angstroms
+            stats: (min, max, mean) of the data
+            rms: standard deviation of the data
+            mode: 'wb' to create a new file or 'rb+' to only
+                replace the header of an existing one.
+        """
+        # Local import to avoid import loop between ImageHandler and Ccp4Header.
+        from pwem.convert import headers
+
+        n, z, y, x = shape
+        mrcMode, _ = _getMrcMode(dtype)
+        if n > 1 and z > 1:
+            ispg = MRC_ISPG_VOLUME_STACK
+        elif z > 1 and not isStack:
+            ispg = MRC_ISPG_VOLUME
+        else:
+            ispg = 0
+        mz = 1 if isStack else z
+
+        # alpha, beta, gamma, mapc, mapr, maps, amin, amax, amean
+        cell = struct.pack('< 3f 3i 3f', 90., 90., 90., 1, 2, 3, *stats)
+        # nsymbt, extra, exttyp, nversion, extra
+        extra = struct.pack('< i 8s 4s i 84s', 0, b'', b'', 20140, b'')
+        headerBytes = struct.pack(headers.Ccp4Header.chain,
+                                  x, y, n * z, mrcMode, 0, 0, 0, x, y, mz,
+                                  x * sampling, y * sampling, mz * sampling,
+                                  cell, ispg, extra, *origin)
+        headerBytes += struct.pack(headers.Ccp4Header.tailChain,
+                                   b'MAP ', b'\x44\x44\x00\x00', rms, 0)
+        headerBytes += b'\x00' * (headers.MRC_HEADER_SIZE - len(headerBytes))
+
+        with open(fn, mode) as f:
+            f.write(headerBytes)
+
+    def readData(self, locationObj):
+        """ Return the numpy data of an image location. MRC files are read
+        with the numpy backend (keeping the last file memory-mapped, so
+        consecutive images of the same stack do not reopen it), other
+        formats are read with the image library.
+        """
+        if not self.isMrcLocation(locationObj):
+            return self.read(locationObj).getData()
+
+        index, fn = self._convertToLocation(locationObj)
+        if self._lastMrc is None or self._lastMrc[0] != fn:
+            self._lastMrc = (fn,) + self._openMrc(fn)
+        _, header, data = self._lastMrc
+        return self._getMrcItem(header, data, index, fn)
+
+    @classmethod
+    def createStackWriter(cls, fnStack, n, sampling=1.0):
+        """ Return an MrcStackWriter to write n images to fnStack. """
+        return MrcStackWriter(fnStack, n, sampling)
+
+    @classmethod
+    def writeMrc(cls, data, locationObj, sampling=1.0, origin=(0., 0., 0.)):
+        """ Write a numpy array to an MRC location.
+        If the location has an index, the image is written in place in
+        the existing stack (that is enlarged if needed), otherwise a new
+        file is created. 3D arrays are stored as stacks of 2D images for
+        .mrcs/.st files (or :mrcs annotation) and as volumes otherwise.
+        sampling (A/px) and origin (A) are only set in new files.
+        """
+        index, fn = cls._convertToLocation(locationObj)
+        isStack = (fn.endswith(':mrcs') or
+                   pwutils.getExt(cls.removeFileType(fn)) in ['.mrcs', '.st'])
+        fn = cls.removeFileType(fn)
+        data = numpy.asarray(data)
+        _, dtype = _getMrcMode(data.dtype)
+
+        if index == emcts.NO_INDEX:
+            if data.ndim == 2:
+                data = data.reshape((1, 1) + data.shape)
+            elif data.ndim == 3:
+                data = data.reshape(((data.shape[0], 1) if isStack else (1, data.shape[0]))
+                                    + data.shape[1:])
+            if data.size and not numpy.iscomplexobj(data):
+                stats = (float(data.min()), float(data.max()), float(data.mean()))
+                rms = float(data.std())
+            else:
+                stats, rms = (0., 0., 0.), 0.
+            cls._writeMrcHeader(fn, data.shape, data.dtype, isStack, sampling,
+                                stats, rms, origin=origin)
+            with open(fn, 'ab') as f:
+                data.astype(dtype.newbyteorder('<'), copy=False).tofile(f)
+            return
+
+        # Write a single item (2D image or volume) in a stack
+        itemShape = (1,) + data.shape if data.ndim == 2 else data.shape
+        if not os.path.exists(fn):
+            cls._writeMrcHeader(fn, (0,) + itemShape, dtype, data.ndim == 2,
+                                sampling, origin=origin)
+        # Local import to avoid import loop between ImageHandler and Ccp4Header.
+        from pwem.convert import headers
+
+        header = headers.Ccp4Header(fn, readHeader=True)
+        x, y, ns = header.getDims()
+        fileType = numpy.dtype(MRC_MODES[header.getMode()])
+        if (y, x) != itemShape[1:]:
+            raise ValueError("Can not write image of dimensions %s in %s with "
+                             "dimensions %s" % (itemShape[1:], fn, (y, x)))
+        z = itemShape[0]
+        n = ns // z
+        if index > n:
+            # Enlarge the stack with empty images up to index
+            header.setDims(x, y, index * z)
+            if z > 1:
+                header.setISPG(MRC_ISPG_VOLUME_STACK)
+                header.setGridSampling(x, y, z)
+            header.writeHeader()
+            with open(fn, 'rb+') as f:
+                f.truncate(header.getDataOffset() +
+                           index * z * y * x * fileType.itemsize)
+            n = index
+
+        stack = numpy.memmap(fn, dtype=fileType.newbyteorder('<'), mode='r+',
+                             offset=header.getDataOffset(), shape=(n,) + itemShape)
+        stack[index - 1] = data.reshape(itemShape)
+        stack.flush()
+        del stack
+
     def createImage(self):
         return self._imgClass()
 
@@ -301,13 +783,29 @@ class ImageHandler(object):
 
         return lib.compareTwoImageTolerance(loc1, loc2, tolerance)
 
-    def computeAverage(self, inputSet):
+    def computeAverage(self, inputSet, numberOfThreads=1, chunkSize=64):
         """ Compute the average image either from filename or set.
         If inputSet is a filename, we will read the whole stack
         and compute the average from all images.
         If inputSet is a SetOfImages subclass, we will iterate
         and compute the average from all images.
+        MRC images are summed with numpy: the images are split in
+        contiguous ranges, one per thread, and each thread reads
+        chunkSize images at a time into its own accumulator. The
+        partial sums are combined at the end.
         """
+        if isinstance(inputSet, str):
+            locations = None
+            isMrc = self.isMrcLocation(inputSet)
+        else:
+            locations = [self._convertToLocation(img) for img in inputSet]
+            isMrc = bool(locations) and self.isMrcLocation(locations[0])
+
+        if isMrc:
+            total, n = self._sumMrc(inputSet, locations, numberOfThreads,
+                                    chunkSize)
+            return self._createImageFromData(total / n) if n else None
+
         if isinstance(inputSet, str):
             _, _, _, n = self.getDimensions(inputSet)
             if n:
@@ -335,6 +833,70 @@ class ImageHandler(object):
 
         return None
 
+    def _createImageFromData(self, data):
+        """ Create an image (as returned by read) holding a numpy array. """
+        data = data.astype(numpy.float32)
+        if getattr(lib, 'GHOST_ACTIVATED', False):
+            img = MrcImage()
+        else:
+            img = self.createImage()
+        img.setData(data)
+        return img
+
+    @classmethod
+    def _sumMrcRange(cls, fn, first, last, chunkSize):
+        """ Sum the images first..last-1 (0-based) of an MRC stack,
+        reading chunkSize images at a time. """
+        _, data = cls._openMrc(fn)
+        if data.shape[1] == 1:  # Stack of 2D images
+            data = data[:, 0]
+        total = numpy.zeros(data.shape[1:], dtype=numpy.float64)
+        for i in range(first, last, chunkSize):
+            block = data[i:min(i + chunkSize, last)]
+            total += block.sum(axis=0, dtype=numpy.float64)
+        return total
+
+    @classmethod
+    def _sumMrcLocations(cls, locations):
+        """ Sum the images in a list of MRC locations. """
+        ih = cls()
+        total = None
+        for loc in locations:
+            data = ih.readData(loc)
+            if total is None:
+                total = numpy.array(data, dtype=numpy.float64)
+            else:
+                total += data
+        return total
+
+    def _sumMrc(self, inputSet, locations, numberOfThreads, chunkSize):
+        """ Return the sum of all MRC images of a file (locations is None)
+        or a list of locations, and the number of summed images. """
+        if locations is None:
+            _, _, _, n = self.getDimensions(inputSet)
+        else:
+            n = len(locations)
+        if not n:
+            return None, 0
+
+        numberOfThreads = max(1, min(numberOfThreads, n))
+        step = int(numpy.ceil(n / numberOfThreads))
+        ranges = [(i, min(i + step, n)) for i in range(0, n, step)]
+
+        def _sum(r):
+            if locations is None:
+                return self._sumMrcRange(inputSet, r[0], r[1], chunkSize)
+            return self._sumMrcLocations(locations[r[0]:r[1]])
+
+        if len(ranges) == 1:
+            partialSums = [_sum(ranges[0])]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                partialSums = list(executor.map(_sum, ranges))
+
+        return sum(partialSums), n
+
     def invertStack(self, inputFn, outputFn):
         # get input dim
         (x, y, z, n) = lib.getImageSize(inputFn)
@@ -447,24 +1009,168 @@ class ImageHandler(object):
                 headers.getFileFormat(imgFn) == headers.MRC)
 
     def computeThumbnail(self, inputFn, outputFn, scaleFactor=6, flipOnY=False,
-                         flipOnX=False):
+                         flipOnX=False, shrinkMethod=SHRINK_FOURIER):
         """ Compute a thumbnail of inputFn, save to ouptutFn.
         Optionally choose a scale factor eg scaleFactor=6 will make
         a thumbnail 6 times smaller.
+        The thumbnail is computed in-process with numpy and PIL: the
+        image is binned (SHRINK_FOURIER: cropping in Fourier space,
+        SHRINK_MEAN: averaging blocks of pixels), its contrast is
+        normalized and it is written as an 8 bits png or jpg.
+        As EMAN2 xform.flip, flipOnY mirrors the image up-down (axis=y)
+        and flipOnX left-right (axis=x).
+        EMAN2 e2proc2d is used for formats that can not be read.
         """
         outputFn = outputFn or self.getThumbnailFn(inputFn)
-        args = '"%s" "%s" ' % (inputFn, outputFn)
+        data = self._readThumbnailData(inputFn)
+
+        if data is None:
+            args = '"%s" "%s" ' % (inputFn, outputFn)
+            if shrinkMethod == self.SHRINK_MEAN:
+                process = "--fixintscaling=sane"
+            else:
+                process = "--process normalize"
+            process += '' if not flipOnY else " --process=xform.flip:axis=y"
+            process += '' if not flipOnX else " --process=xform.flip:axis=x"
 
-        process = "--process normalize"
-        process += '' if not flipOnY else " --process=xform.flip:axis=y"
-        process += '' if not flipOnX else " --process=xform.flip:axis=x"
+            args += "--%s %s %s" % (shrinkMethod, scaleFactor, process)
 
-        args += "--fouriershrink %s %s" % (scaleFactor, process)
+            self.__runEman2Program('e2proc2d.py', args)
+            return outputFn
 
-        self.__runEman2Program('e2proc2d.py', args)
+        data = self._shrink(data, scaleFactor, shrinkMethod)
+        if flipOnY:
+            data = numpy.flipud(data)
+        if flipOnX:
+            data = numpy.fliplr(data)
+        Image.fromarray(self._normalizeToUint8(data)).save(outputFn)
 
         return outputFn
 
+    def computeThumbnails(self, inputFns, outputFns=None, numberOfThreads=1,
+                          **kwargs):
+        """ Compute the thumbnails of a list of images (see computeThumbnail).
+        Params:
+            inputFns: list of input images
+            outputFns: list of output thumbnails, if None the default
+                names are used (see getThumbnailFn)
+            numberOfThreads: number of images processed in parallel
+            kwargs: extra arguments passed to computeThumbnail
+        Returns the list of written thumbnails.
+        """
+        outputFns = outputFns or [self.getThumbnailFn(fn) for fn in inputFns]
+
+        def _compute(fns):
+            return type(self)().computeThumbnail(fns[0], fns[1], **kwargs)
+
+        pairs = list(zip(inputFns, outputFns))
+        if numberOfThreads <= 1 or len(pairs) <= 1:
+            return [_compute(pair) for pair in pairs]
+
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=numberOfThreads) as executor:
+            return list(executor.map(_compute, pairs))
+
+    def _readThumbnailData(self, inputFn):
+        """ Read the 2D data used to compute a thumbnail. Returns None
+        if the format can not be read in-process. The first image is
+        used for stacks and the central slice for volumes. """
+        fn = self.removeFileType(inputFn)
+        ext = pwutils.getExt(fn).lower()
+
+        if self.isMrcLocation(inputFn):
+            data = self.readMrc(inputFn)
+        elif ext in ['.png', '.jpg', '.jpeg']:
+            data = numpy.asarray(Image.open(fn).convert('F'))
+        elif ext in ['.tif', '.tiff']:
+            with TiffFile(fn) as tif:
+                data = tif.pages[0].asarray()
+        elif not getattr(lib, 'GHOST_ACTIVATED', False):
+            data = self.read(inputFn).getData()
+        else:
+            return None
+
+        if data.ndim == 4:  # Stack of volumes
+            data = data[0]
+        if data.ndim == 3:
+            data = data[data.shape[0] // 2]
+        return data
+
+    @classmethod
+    def _shrink(cls, data, scaleFactor, shrinkMethod=None):
+        """ Bin a 2D image by scaleFactor. """
+        if scaleFactor <= 1:
+            return data
+        if shrinkMethod == cls.SHRINK_MEAN and float(scaleFactor).is_integer():
+            f = int(scaleFactor)
+            y, x = data.shape[0] // f, data.shape[1] // f
+            return data[:y * f, :x * f].reshape(y, f, x, f).mean(axis=(1, 3),
+                                                                 dtype=numpy.float64)
+
+        y, x = data.shape
+        return cls._fourierResize(data, (max(1, int(y / scaleFactor)),
+                                         max(1, int(x / scaleFactor))))
+
+    @staticmethod
+    def _fourierResize(data, shape):
+        """ Resize the last len(shape) dimensions of data (a 2D image, a
+        volume or a batch of them) to shape by cropping or padding their
+        Fourier transform. Intensities are kept (not the total sum). """
+        axes = tuple(range(-len(shape), 0))
+        ft = numpy.fft.fftshift(numpy.fft.fftn(data, axes=axes), axes=axes)
+        batchShape = data.shape[:-len(shape)]
+        out = numpy.zeros(batchShape + tuple(shape), dtype=ft.dtype)
+        # Copy the central (lowest frequencies) region common to both shapes
+        sliceIn = [slice(None)] * len(batchShape)
+        sliceOut = list(sliceIn)
+        for dimIn, dimOut in zip(data.shape[-len(shape):], shape):
+            n = min(dimIn, dimOut)
+            startIn = dimIn // 2 - n // 2
+            startOut = dimOut // 2 - n // 2
+            sliceIn.append(slice(startIn, startIn + n))
+            sliceOut.append(slice(startOut, startOut + n))
+        out[tuple(sliceOut)] = ft[tuple(sliceIn)]
+        result = numpy.fft.ifftn(numpy.fft.ifftshift(out, axes=axes),
+                                 axes=axes).real
+        factor = numpy.prod(shape) / float(numpy.prod(data.shape[-len(shape):]))
+        return (result * factor).astype(numpy.float32)
+
+    @classmethod
+    def fourierResize(cls, data, shape, chunkSize=64):
+        """ Resize an image, a volume or a stack of them (numpy arrays
+        with the shapes returned by readMrc) to new dimensions by
+        cropping or padding in Fourier space.
+        Params:
+            data: numpy array with the input data
+            shape: output dimensions, (y, x) for images or
+                (z, y, x) for volumes
+            chunkSize: number of stack items transformed at once
+        """
+        ndim = len(shape)
+        if data.ndim == ndim:
+            return cls._fourierResize(data, shape)
+
+        # Stacks are processed in chunks to bound the memory used
+        result = numpy.empty(data.shape[:-ndim] + tuple(shape),
+                             dtype=numpy.float32)
+        for i in range(0, data.shape[0], chunkSize):
+            result[i:i + chunkSize] = cls._fourierResize(data[i:i + chunkSize],
+                                                         shape)
+        return result
+
+    @staticmethod
+    def _normalizeToUint8(data, nSigma=4.):
+        """ Scale the image to 0-255, clipping values beyond
+        nSigma standard deviations from the mean. """
+        data = numpy.asarray(data, dtype=numpy.float64)
+        mean, std = data.mean(), data.std()
+        low = max(data.min(), mean - nSigma * std)
+        high = min(data.max(), mean + nSigma * std)
+        if high <= low:
+            return numpy.zeros(data.shape, dtype=numpy.uint8)
+        data = numpy.clip((data - low) * (255. / (high - low)), 0, 255)
+        return data.astype(numpy.uint8)
+
     @staticmethod
     def getThumbnailFn(inputFn):
         """Replace the extension in inputFn with thumb.png"""
@@ -496,16 +1202,41 @@ class ImageHandler(object):
 
     @classmethod
     def scaleFourier(cls, inputFn, outputFn, scaleFactor):
-        """ Scale an image by cropping in Fourier space. """
-        # TODO: Avoid using xmipp program for this
-        cls.__runXmippProgram("xmipp_transform_downsample",
-                              "-i %s -o %s --step %f --method fourier"
-                              % (inputFn, outputFn, scaleFactor))
+        """ Scale an image by cropping in Fourier space.
+        The output dimensions are the input ones divided by scaleFactor.
+        MRC images, volumes and stacks are scaled in-process (see
+        fourierResize), other formats with xmipp_transform_downsample.
+        """
+        if not (cls.isMrcLocation(inputFn) and cls.isMrcLocation(outputFn)):
+            cls.__runXmippProgram("xmipp_transform_downsample",
+                                  "-i %s -o %s --step %f --method fourier"
+                                  % (inputFn, outputFn, scaleFactor))
+            return
+
+        # Local import to avoid import loop between ImageHandler and Ccp4Header.
+        from pwem.convert import headers
+
+        data = cls.readMrc(inputFn)
+        # Stacks of 2D images are scaled only in x and y
+        isStack2D = data.ndim == 4 and data.shape[1] == 1
+        ndim = 2 if data.ndim == 2 or isStack2D else 3
+        shape = tuple(max(1, int(round(d / scaleFactor)))
+                      for d in data.shape[-ndim:])
+        if isStack2D:
+            data = data[:, 0]
+        sampling = headers.Ccp4Header(inputFn, readHeader=True).getSampling()[0]
+        cls.writeMrc(cls.fourierResize(data, shape), outputFn,
+                     sampling=(sampling or 1.0) * scaleFactor)
 
     @classmethod
     def scaleSplines(cls, inputFn, outputFn, scaleFactor, finalDimension=None,
                      forceVolume=False):
         """ Scale an image using splines. """
+        if getattr(lib, 'GHOST_ACTIVATED', False) and cls.isMrcLocation(inputFn):
+            cls._scaleSplinesMrc(inputFn, outputFn, scaleFactor,
+                                 finalDimension, forceVolume)
+            return
+
         I = lib.Image()
         I.read(inputFn)
         x, y, z, n = I.getDimensions()
@@ -521,35 +1252,58 @@ class ImageHandler(object):
         I.scale(x, y, z, setDimensions)
         I.write(outputFn)
 
+    @classmethod
+    def _scaleSplinesMrc(cls, inputFn, outputFn, scaleFactor, finalDimension,
+                         forceVolume):
+        """ scaleSplines for MRC files when xmipp is not available,
+        using cubic splines from scipy. """
+        from scipy import ndimage
+
+        data = cls.readMrc(inputFn)
+        isStack2D = data.ndim == 4 and data.shape[1] == 1
+        if isStack2D and forceVolume:
+            data = data[:, 0]  # Stack of images read as a volume
+            isStack2D = False
+        # Only x, y and z are scaled (not the stack dimension)
+        ndim = 2 if data.ndim == 2 or isStack2D else 3
+        if finalDimension is not None:
+            zoom = [float(finalDimension) / d for d in data.shape[-ndim:]]
+        else:
+            zoom = [scaleFactor] * ndim
+        zoom = [1] * (data.ndim - ndim) + zoom
+        cls.writeMrc(ndimage.zoom(numpy.asarray(data, dtype=numpy.float32),
+                                  zoom, order=3), outputFn)
+
     @classmethod
     def scale2DStack(cls, inputFn, outputFn, scaleFactor=None, finalDimension=None):
         """
-         Scale a 2D images stack using PIL.
+         Scale a 2D images stack cropping or padding in Fourier space
+         (see fourierResize). All the images are scaled in-process.
         """
-        from PIL import Image
         if scaleFactor is None and finalDimension is None:
             raise TypeError("scaleFactor or finalDimension must be passed")
 
-        I = lib.Image()
-        I.read(inputFn)
-        x, y, z, n = I.getDimensions()
+        if cls.isMrcLocation(inputFn):
+            data = cls.readMrc(inputFn)
+        else:
+            I = lib.Image()
+            I.read(inputFn)
+            data = I.getData()
+        x = data.shape[-1]
+        data = data.reshape((-1,) + data.shape[-2:])
 
         if not finalDimension:
             finalDimension = round(x*scaleFactor)
 
-        objects = I.getData()
+        newStack = cls.fourierResize(data, (finalDimension, finalDimension))
+        newStack = newStack.reshape((newStack.shape[0], 1) + newStack.shape[1:])
 
-        newStack = numpy.zeros((n, 1, finalDimension, finalDimension))
-        count = 0
-        for object in objects:
-            slice = object[0]
-            image = Image.fromarray(slice)
-            resizedImage = image.resize((finalDimension, finalDimension))
-            newStack[count] = numpy.array(resizedImage)
-            count += 1
-
-        I.setData(newStack)
-        I.write(outputFn)
+        if cls.isMrcLocation(outputFn):
+            cls.writeMrc(newStack, outputFn)
+        else:
+            I = lib.Image()
+            I.setData(newStack)
+            I.write(outputFn)
 
     @staticmethod
     def applyTransform(inputFile, outputFile, transformMatrix, shape, fillValue=None, doWrap=False):
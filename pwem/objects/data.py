@@ -33,6 +33,7 @@ logger = logging.getLogger(__name__)
 
 import os
 import json
+from itertools import groupby
 import numpy as np
 
 import pyworkflow.utils as pwutils
@@ -355,6 +356,9 @@ class CTFModel(EMObject):
     def setMicrograph(self, mic):
         self._micObj = mic
         self.copyObjId(mic)
+        # The file dimensions are only stored in sets of micrographs
+        if isinstance(mic, Micrograph):
+            mic._storeFileDimensions(False)
 
     def getDefocus(self):
         """ Returns defocusU, defocusV and defocusAngle. """
@@ -766,6 +770,66 @@ class Micrograph(Image):
     def __init__(self, location=None, **kwargs):
         Image.__init__(self, location, **kwargs)
         self._micName = String()
+        # Dimensions (x, y, z, n) read from the file and the file
+        # modification time, to avoid reading the header on every call.
+        # They are only stored in sets of micrographs (see
+        # SetOfMicrographsBase.append), not in nested micrographs
+        self._fileDim = CsvList(pType=int, objDoStore=False)
+        self._fileMTime = Float(objDoStore=False)
+
+    def _storeFileDimensions(self, doStore=True):
+        self._fileDim.setStore(doStore)
+        self._fileMTime.setStore(doStore)
+
+    def setAttributeValue(self, attrName, value, ignoreMissing=True):
+        # Items read from a set that stores the file dimensions store them
+        if attrName in ('_fileDim', '_fileMTime'):
+            getattr(self, attrName).setStore(True)
+        Image.setAttributeValue(self, attrName, value, ignoreMissing)
+
+    def setFileName(self, filename):
+        # Cached dimensions are not valid for a new file (the attributes
+        # do not exist yet when the location is set from the constructor)
+        if hasattr(self, '_fileDim') and filename != self.getFileName():
+            self._fileDim.set([])
+            self._fileMTime.set(None)
+        Image.setFileName(self, filename)
+
+    def _getFileDimensions(self):
+        """ Return the (x, y, z, n) dimensions of the file. The header is
+        only read if the file was modified since the last time. """
+        from pwem.emlib.image import ImageHandler
+        fn = self.getFileName()
+        fn = ImageHandler.removeFileType(fn) if fn else fn
+        if not fn or not os.path.exists(fn):
+            return ImageHandler().getDimensions(self)
+
+        mTime = os.path.getmtime(fn)
+        if self._fileDim.isEmpty() or self._fileMTime.get() != mTime:
+            dims = ImageHandler().getDimensions(self)
+            if dims[0] is None:
+                return dims
+            self._fileDim.set(list(dims))
+            self._fileMTime.set(mTime)
+
+        return tuple(self._fileDim)
+
+    def _hasNativeHeader(self):
+        """ Return True if the dimensions can be read from the file header
+        in-process (MRC and TIFF files), i.e. without xmipp nor an external
+        program. Compressed files are not read either. """
+        from pwem.convert import headers
+        fn = self.getFileName()
+        if not fn:
+            return False
+        ext = pwutils.getExt(fn).lower()
+        return (headers.getFileFormat(fn) == headers.MRC or
+                ext in ['.eer', '.gain', '.tif', '.tiff'])
+
+    def getDim(self):
+        """Return image dimensions as tuple: (Xdim, Ydim, Zdim)"""
+        x, y, z, n = self._getFileDimensions()
+        return None if x is None else (x, y, z)
 
     def setMicName(self, micName):
         self._micName.set(micName)
@@ -1134,6 +1198,7 @@ class PdbFile(AtomStruct):
 
 class EMSet(Set, EMObject):
     _classesDict = None
+    _bulkRows = None  # rows pending to be inserted during copyItems
 
     def _loadClassesDict(self):
 
@@ -1160,7 +1225,9 @@ class EMSet(Set, EMObject):
                   updateItemCallback=None,
                   itemDataIterator=None,
                   copyDisabled=False,
-                  doClone=True):
+                  doClone=True,
+                  batchSize=1000,
+                  itemIds=None):
         """ Copy items from another set, allowing to update items information
         based on another source of data, paired with each item.
 
@@ -1181,23 +1248,347 @@ class EMSet(Set, EMObject):
                 of the input item. By using doClone=False, the same input item
                 will be passed to the callback and added to the set. This will
                 avoid the clone operation and the related overhead.
+            batchSize: rows are inserted in batches of this size with a single
+                executemany. If there is no callback nor data iterator, the
+                rows are copied with an INSERT ... SELECT between the two
+                databases when possible. Use 0 to insert the items one by one.
+            itemIds: if not None, only the items with these ids are copied.
+                Without callback nor data iterator, they are selected in
+                sqlite, so the other items are not even loaded.
         """
         itemDataIter = itemDataIterator  # shortcut
+        bulk = batchSize and type(self)._insertItem is EMSet._insertItem
+
+        if (bulk and updateItemCallback is None and itemDataIter is None
+                and self._copyRows(otherSet, copyDisabled, doClone,
+                                   idSet=itemIds)):
+            return
+
+        if itemIds is not None:
+            itemIds = set(itemIds)
+
+        self._setBulkSize(batchSize)
+
+        try:
+            for item in otherSet:
+                # copy items if enabled or copyDisabled=True
+                if ((copyDisabled or item.isEnabled()) and
+                        (itemIds is None or item.getObjId() in itemIds)):
+                    newItem = item.clone() if doClone else item
+                    if updateItemCallback:
+                        row = None if itemDataIter is None else next(itemDataIter)
+                        updateItemCallback(newItem, row)
+                    # If updateCallBack function returns attribute
+                    # _appendItem to False do not append the item
+                    if getattr(newItem, "_appendItem", True):
+                        self.append(newItem)
+                else:
+                    if itemDataIter is not None:
+                        next(itemDataIter)  # just skip disabled data row
+        finally:
+            self._setBulkSize(0)
+
+    def _setBulkSize(self, batchSize):
+        """ Keep the rows of the appended items to insert them in batches
+        of batchSize, if _insertItem does not modify the items. Use 0 to
+        insert the pending rows and go back to inserting one by one.
+        """
+        self._flushRows()
+        bulk = batchSize and type(self)._insertItem is EMSet._insertItem
+        self._bulkRows = [] if bulk else None
+        self._bulkSize = batchSize
+
+    def _insertItem(self, item):
+        """ Insert the item, or keep its row to be inserted
+        in the next batch in bulk mode (see _setBulkSize).
+        """
+        mapper = self._getMapper()
+
+        if self._bulkRows is None or mapper.doCreateTables:
+            Set._insertItem(self, item)
+        else:
+            self._bulkRows.append((item.getObjId(), item.isEnabled(),
+                                   item.getObjLabel(), item.getObjComment(),
+                                   *mapper._getValuesFromObject(item).values()))
+            if len(self._bulkRows) >= self._bulkSize:
+                self._flushRows()
+
+    def _flushRows(self):
+        """ Insert the pending rows in bulk mode. """
+        if self._bulkRows:
+            db = self._getMapper().db
+            db.connection.executemany(db.INSERT_OBJECT, self._bulkRows)
+            self._bulkRows = []
+
+    def _canCopyRows(self, otherSet):
+        """ Return True if the rows of otherSet can be copied as they are,
+        i.e. append and _insertItem do not modify the items.
+        """
+        return (type(self).append is Set.append and
+                type(self)._insertItem is EMSet._insertItem)
+
+    @staticmethod
+    def _getDbClasses(db):
+        """ Return a dict with the (column, className) of each stored
+        attribute, including 'self', read from the Classes table.
+        """
+        cursor = db.connection.cursor()
+        cursor.execute("SELECT label_property, column_name, class_name "
+                       "FROM %sClasses" % db.tablePrefix)
+        return {label: (column, className)
+                for label, column, className in cursor}
+
+    def copyRowsById(self, otherSet, idSet, difference=False):
+        """ Copy the items of otherSet whose id is also in idSet (or is not,
+        if difference is True). idSet is another set or a list of ids. The
+        selection is done with a single SQL query joining the databases of
+        the three sets (or a temporary table with the ids), so the items
+        are neither loaded nor cloned (the enabled flag is kept).
+        Returns False, without copying anything, if the rows can not be
+        copied directly (see copyItems).
+        """
+        return self._copyRows(otherSet, copyDisabled=True, doClone=False,
+                              idSet=idSet, difference=difference)
+
+    def copyRowsByKey(self, otherSet, keyAttr, attrName, valuesByKey):
+        """ Copy the items of otherSet whose keyAttr value (e.g.
+        '_coordinate._micName') is in valuesByKey, setting their attrName
+        (e.g. '_ctfModel') to the object of that key. The values of each
+        key are computed once and joined in sqlite with the rows, so the
+        items are neither loaded nor cloned (like clone, they are enabled).
+        Returns False, without copying anything, if the rows can not be
+        copied directly (see copyItems).
+        """
+        return self._copyRows(otherSet, copyDisabled=True, doClone=True,
+                              join=(keyAttr, attrName, valuesByKey))
 
-        for item in otherSet:
-            # copy items if enabled or copyDisabled=True
-            if copyDisabled or item.isEnabled():
-                newItem = item.clone() if doClone else item
-                if updateItemCallback:
-                    row = None if itemDataIter is None else next(itemDataIter)
-                    updateItemCallback(newItem, row)
-                # If updateCallBack function returns attribute
-                # _appendItem to False do not append the item
-                if getattr(newItem, "_appendItem", True):
-                    self.append(newItem)
+    def appendRows(self, otherSet, newIds=False, skipDuplicates=False,
+                   incremental=False):
+        """ Append all the items of otherSet (enabled or not) with a single
+        INSERT ... SELECT, without loading nor cloning them.
+
+        Params:
+            otherSet: input set from where the rows will be copied.
+            newIds: give new consecutive ids to the appended items.
+            skipDuplicates: do not append the items whose id is already
+                in this set (the first occurrence is kept).
+            incremental: only append the items added to otherSet since
+                the last call. The last appended id of each input is kept
+                as a property of this set, so it works with sets that
+                only grow, like streaming sets.
+        Returns False, without appending anything, if the rows can not be
+        copied directly (see copyItems).
+        """
+        otherMapper = otherSet._getMapper()
+        if otherMapper.db.missingTables():
+            return True  # nothing to append
+
+        key = 'appendedRows:%s,%s' % (os.path.abspath(otherSet.getFileName()),
+                                      otherSet.getPrefix())
+        fromId = int(self.getProperty(key, 0)) if incremental else None
+        toId = otherMapper.maxId()
+
+        if not self._copyRows(otherSet, copyDisabled=True, doClone=False,
+                              newIds=newIds, skipExisting=skipDuplicates,
+                              fromId=fromId, toId=toId):
+            return False
+
+        if incremental:
+            self._getMapper().setProperty(key, toId)
+        return True
+
+    def _copyRows(self, otherSet, copyDisabled=False, doClone=True,
+                  idSet=None, difference=False, newIds=False,
+                  skipExisting=False, fromId=None, toId=None, join=None):
+        """ Copy all the rows of otherSet with a single INSERT ... SELECT,
+        optionally only those whose id is (or is not) in idSet (a set or
+        a list of ids), is not already in this set (skipExisting) or is in
+        the range (fromId, toId].
+        If newIds, the rows are given new consecutive ids.
+        join is a tuple (keyAttr, attrName, valuesByKey), see copyRowsByKey.
+        Return False, without copying anything, if the two sets are not
+        stored in compatible sqlite tables.
+        """
+        if not isinstance(otherSet, EMSet) or not self._canCopyRows(otherSet):
+            return False
+
+        otherDb = otherSet._getMapper().db
+        idDb = idSet._getMapper().db if isinstance(idSet, EMSet) else None
+        for sourceDb in filter(None, [otherDb, idDb]):
+            if (sourceDb.missingTables() or
+                    not os.path.exists(sourceDb.getDbName()) or
+                    sourceDb.connection.in_transaction):
+                return False
+
+        otherColumns = self._getDbClasses(otherDb)
+        if join is not None:
+            keyAttr, attrName, valuesByKey = join
+            if keyAttr not in otherColumns:
+                return False
+            if not valuesByKey:
+                return True  # nothing to copy
+
+            def _isJoinLabel(label):
+                return label == attrName or label.startswith(attrName + '.')
+
+            otherColumns = {k: v for k, v in otherColumns.items()
+                            if not _isJoinLabel(k)}
+
+        mapper = self._getMapper()
+        db = mapper.db
+        db.commit()  # ATTACH is not allowed inside a transaction
+        schemas = {os.path.abspath(db.getDbName()): 'main'}
+        attached = []
+
+        for sourceDb in filter(None, [otherDb, idDb]):
+            fn = os.path.abspath(sourceDb.getDbName())
+            if fn not in schemas:
+                schemas[fn] = 'copySrc%d' % len(attached)
+                db.connection.execute("ATTACH DATABASE ? AS %s"
+                                      % schemas[fn], (fn,))
+                attached.append(schemas[fn])
+
+        def _table(sourceDb):
+            return '%s.%sObjects' % (schemas[os.path.abspath(sourceDb.getDbName())],
+                                     sourceDb.tablePrefix)
+
+        where = [] if copyDisabled else ['enabled=1']
+        if idDb is not None:
+            where.append('id %sIN (SELECT id FROM %s)'
+                         % ('NOT ' if difference else '', _table(idDb)))
+        if fromId is not None:
+            where.append('id>%d' % fromId)
+        if toId is not None:
+            where.append('id<=%d' % toId)
+        existing = 'id NOT IN (SELECT id FROM main.%sObjects)' % db.tablePrefix
+        if skipExisting and not mapper.doCreateTables:
+            where.append(existing)
+
+        try:
+            if idSet is not None and idDb is None:
+                db.connection.execute("DROP TABLE IF EXISTS temp.copyIds")
+                db.connection.execute("CREATE TEMP TABLE copyIds "
+                                      "(id INTEGER PRIMARY KEY)")
+                db.connection.executemany("INSERT OR IGNORE INTO temp.copyIds "
+                                          "VALUES (?)",
+                                          ((int(i),) for i in idSet))
+                where.append('id %sIN (SELECT id FROM temp.copyIds)'
+                             % ('NOT ' if difference else ''))
+
+            keyColumn = 'NULL'
+            if join is not None:
+                keyColumn = otherColumns[keyAttr][0]
+                db.connection.execute("DROP TABLE IF EXISTS temp.copyJoin")
+                db.connection.execute("CREATE TEMP TABLE copyJoin (key PRIMARY KEY)")
+                db.connection.executemany("INSERT INTO temp.copyJoin VALUES (?)",
+                                          ((k,) for k in valuesByKey))
+                where.append('%s IN (SELECT key FROM temp.copyJoin)' % keyColumn)
+
+            firstItem = None
+            if mapper.doCreateTables:
+                # The first item will be appended as usual to create the tables
+                cursor = db.connection.cursor()
+                cursor.execute("SELECT id, %s FROM %s %s ORDER BY id LIMIT 1"
+                               % (keyColumn, _table(otherDb), self._whereStr(where)))
+                row = cursor.fetchone()
+                if row is None:
+                    return True  # nothing to copy
+                firstId = row[0]
+                firstItem = otherSet[firstId]
+                if doClone:
+                    firstItem = firstItem.clone()
+                if join is not None:
+                    setattr(firstItem, attrName, valuesByKey[row[1]])
+                classes = {k: v[0] for k, v in
+                           firstItem.getObjDict(includeClass=True).items()}
+                classes['self'] = firstItem.getClassName()
             else:
-                if itemDataIter is not None:
-                    next(itemDataIter)  # just skip disabled data row
+                classes = {k: v[1] for k, v in self._getDbClasses(db).items()}
+
+            if 'self' not in otherColumns or any(
+                    k in otherColumns and otherColumns[k][1] != c
+                    for k, c in classes.items()):
+                return False
+
+            if firstItem is not None:
+                if newIds:
+                    firstItem.cleanObjId()
+                self.append(firstItem)
+                where.append('id>%d' % firstId)
+                if skipExisting:
+                    where.append(existing)
+
+            columns = self._getDbClasses(db)
+            labels = [k for k in columns if k != 'self' and k in otherColumns]
+            values = ''.join(', %s' % otherColumns[k][0] for k in labels)
+            source = _table(otherDb)
+            params = []
+
+            missing = [k for k in columns if k != 'self' and k not in labels
+                       and not (join is not None and _isJoinLabel(k))]
+            template = firstItem
+            if template is None and join is not None:
+                template = self.getFirstItem().clone()
+            elif template is None and missing:
+                template = otherSet.getFirstItem()
+
+            if missing:
+                # Attributes not stored in the other set have the same
+                # value in all its items, take it from the first one
+                itemValues = template.getObjDict()
+                if any(k not in itemValues for k in missing):
+                    return False
+                labels += missing
+                values += ', ?' * len(missing)
+                params = [itemValues.get(k) for k in missing]
+
+            if join is not None:
+                # Compute the columns of attrName once for each key
+                joinLabels = [k for k in columns if _isJoinLabel(k)]
+                rows = []
+                for key, value in valuesByKey.items():
+                    setattr(template, attrName, value)
+                    itemValues = mapper._getValuesFromObject(template)
+                    rows.append((key,) + tuple(itemValues.get(k)
+                                               for k in joinLabels))
+                db.connection.execute("DROP TABLE temp.copyJoin")
+                db.connection.execute(
+                    "CREATE TEMP TABLE copyJoin (key PRIMARY KEY%s)"
+                    % ''.join(', v%d' % i for i in range(len(joinLabels))))
+                db.connection.executemany(
+                    "INSERT INTO temp.copyJoin VALUES (%s)"
+                    % ', '.join('?' * len(rows[0])), rows)
+                labels += joinLabels
+                values += ''.join(', v%d' % i for i in range(len(joinLabels)))
+                source += ' JOIN temp.copyJoin ON key=%s' % keyColumn
+
+            # clone does not copy the enabled flag
+            cmd = ("INSERT INTO %sObjects (id, enabled, label, comment, creation%s) "
+                   "SELECT %s, %s, label, comment, datetime('now')%s "
+                   "FROM %s %s ORDER BY id"
+                   % (db.tablePrefix,
+                      ''.join(', %s' % columns[k][0] for k in labels),
+                      # NULL ids are assigned consecutively after the max id
+                      'NULL' if newIds else 'id',
+                      '1' if doClone else 'enabled',
+                      values, source, self._whereStr(where)))
+            db.connection.execute(cmd, params)
+        finally:
+            db.commit()
+            if join is not None:
+                db.connection.execute("DROP TABLE IF EXISTS temp.copyJoin")
+            if idSet is not None and idDb is None:
+                db.connection.execute("DROP TABLE IF EXISTS temp.copyIds")
+            for schema in attached:
+                db.connection.execute("DETACH DATABASE %s" % schema)
+
+        self._size.set(mapper.count())
+        self._idCount = max(self._idCount, mapper.maxId())
+        return True
+
+    @staticmethod
+    def _whereStr(conditions):
+        return 'WHERE %s' % ' AND '.join(conditions) if conditions else ''
 
     @classmethod
     def create(cls, outputPath,
@@ -1257,6 +1648,109 @@ class EMSet(Set, EMObject):
     def getFiles(self):
         return Set.getFiles(self)
 
+    def _getColumnClasses(self):
+        """ Return a dict with the (column, className) of each item attribute
+        stored in the set database.
+        """
+        db = self._getMapper().db
+        columns = {'id': ('id', 'Integer'),
+                   'enabled': ('enabled', 'Boolean')}
+        if not db.missingTables():
+            columns.update((label, value) for label, value
+                           in self._getDbClasses(db).items() if label != 'self')
+        return columns
+
+    @staticmethod
+    def _valuesToArray(values, className):
+        """ Convert the values of a column to a numpy array. """
+        if className == 'Matrix':
+            if not values:
+                return np.empty((0, 4, 4))
+            return np.stack([np.full((4, 4), np.nan) if v is None
+                             else Matrix.decodeValue(v) for v in values])
+        if className == 'Float' or (className == 'Integer' and None in values):
+            return np.array(values, dtype=float)
+        if className == 'Integer':
+            return np.array(values, dtype=int)
+        if className == 'Boolean':
+            return np.array(values, dtype=bool)
+        return np.array(values, dtype=object)
+
+    @staticmethod
+    def _arrayToValues(array, className):
+        """ Convert a numpy array to a list of values to be stored. """
+        if className == 'Matrix':
+            return [Matrix.encodeValue(m) for m in np.asarray(array)]
+        return np.asarray(array).tolist()
+
+    def getArrays(self, attributes, where=None, orderBy='id', direction='ASC'):
+        """ Return item attributes as numpy arrays, read directly from the
+        set database without creating the items.
+
+        Params:
+            attributes: list of item attributes, e.g: ['id', '_ctfModel._defocusU'].
+            where: condition in terms of item attributes, as in iterItems.
+            orderBy: attribute or list of attributes to sort the rows.
+            direction: 'ASC' or 'DESC'.
+        Returns:
+            a dict with an array per attribute. Missing Float values are NaN
+            and Matrix attributes (e.g. '_transform._matrix') are (N, 4, 4).
+        """
+        attributes = pwutils.valueToList(attributes)
+        db = self._getMapper().db
+        columns = self._getColumnClasses()
+
+        for attr in attributes + pwutils.valueToList(orderBy):
+            if attr not in columns:
+                raise Exception('getArrays: attribute %s not found in %s'
+                                % (attr, self.getFileName()))
+
+        if db.missingTables():  # nothing appended yet
+            rows = []
+        else:
+            cmd = "SELECT %s %s" % (', '.join(columns[a][0] for a in attributes),
+                                    db.FROM)
+            whereStr = db._whereToWhereStr(where)
+            if whereStr:
+                cmd += " WHERE %s" % whereStr
+            cmd += " ORDER BY %s %s" % (', '.join(columns[a][0] for a in
+                                                  pwutils.valueToList(orderBy)),
+                                        direction)
+            cursor = db.connection.cursor()
+            cursor.row_factory = None
+            rows = cursor.execute(cmd).fetchall()
+
+        values = list(zip(*rows)) if rows else [()] * len(attributes)
+
+        return {attr: self._valuesToArray(list(v), columns[attr][1])
+                for attr, v in zip(attributes, values)}
+
+    def setArrays(self, ids, arrays):
+        """ Update item attributes in bulk from numpy arrays, without
+        creating the items. As with update, write should be called
+        afterwards to commit the changes.
+
+        Params:
+            ids: ids of the items to update.
+            arrays: dict with an array of values (one per id) for each
+                attribute, as returned by getArrays.
+        """
+        db = self._getMapper().db
+        columns = self._getColumnClasses()
+        attributes = [a for a in arrays if a != 'id']
+
+        for attr in attributes:
+            if attr not in columns:
+                raise Exception('setArrays: attribute %s not found in %s'
+                                % (attr, self.getFileName()))
+
+        values = [self._arrayToValues(arrays[a], columns[a][1])
+                  for a in attributes]
+        values.append(np.asarray(ids).tolist())
+        cmd = "UPDATE %sObjects SET %s WHERE id=?" % (
+            db.tablePrefix, ', '.join('%s=?' % columns[a][0] for a in attributes))
+        db.connection.cursor().executemany(cmd, zip(*values))
+
 
 class SetOfImages(EMSet):
     """ Represents a set of Images """
@@ -1271,6 +1765,21 @@ class SetOfImages(EMSet):
         self._isAmplitudeCorrected = Boolean(False)
         self._acquisition = Acquisition()
         self._firstDim = ImageDim()  # Dimensions of the first image
+        # Homogeneous sets store sampling rate and acquisition only once
+        self._homogeneous = Boolean(kwargs.get('homogeneous', False))
+
+    def isHomogeneous(self):
+        """ Return True if all the images share the sampling rate and the
+        acquisition of the set. These are not stored per image and are
+        attached to the images when iterating.
+        """
+        return self._homogeneous.get()
+
+    def setHomogeneous(self, value):
+        """ Set the homogeneous mode. It only applies to the images
+        appended to an empty set.
+        """
+        self._homogeneous.set(value)
 
     def getAcquisition(self):
         return self._acquisition
@@ -1331,6 +1840,10 @@ class SetOfImages(EMSet):
 
     def append(self, image):
         """ Add a image to the set. """
+        if self.isHomogeneous():
+            self._appendHomogeneous(image)
+            return
+
         # If the sampling rate was set before, the same value
         # will be set for each image added to the set
         if self.getSamplingRate() or not image.getSamplingRate():
@@ -1350,6 +1863,72 @@ class SetOfImages(EMSet):
 
         EMSet.append(self, image)
 
+    def _appendHomogeneous(self, image):
+        """ Append an image without its sampling rate and acquisition.
+        The stored columns are fixed by the first image, so only this one
+        needs to exclude them.
+        """
+        if not self._getMapper().doCreateTables:
+            EMSet.append(self, image)
+            return
+
+        self._setFirstDim(image)
+        samplingRate, acquisition = image._samplingRate, image._acquisition
+        doStore = samplingRate._objDoStore
+        samplingRate.setStore(False)
+        image._acquisition = None
+        try:
+            EMSet.append(self, image)
+        finally:
+            samplingRate.setStore(doStore)
+            image._acquisition = acquisition
+
+    def _hasSharedInfo(self):
+        """ Return True if the rows do not store the sampling rate,
+        which is then taken from the set.
+        """
+        mapper = self._getMapper()
+        return (not mapper.doCreateTables and
+                '_samplingRate' not in mapper.db._columnsMapping)
+
+    def _useSharedInfo(self):
+        """ Return True if the images take the sampling rate and acquisition
+        from the set, loading the set properties if the set was opened
+        from its sqlite file.
+        """
+        sharedInfo = self.isHomogeneous() or self._hasSharedInfo()
+        if sharedInfo and not self.getSamplingRate():
+            self.loadAllProperties()  # set opened from its sqlite file
+        return sharedInfo
+
+    def _attachSetInfo(self, img):
+        """ Set the sampling rate and acquisition of the set to the image. """
+        img.setSamplingRate(self.getSamplingRate())
+        img.setAcquisition(self.getAcquisition())
+        return img
+
+    def _canCopyRows(self, otherSet):
+        """ Rows can be copied as they are if the images would not get
+        a different sampling rate or acquisition when appended.
+        """
+        if (type(self).append not in (SetOfImages.append,
+                                      SetOfMicrographsBase.append) or
+                type(self)._insertItem is not EMSet._insertItem):
+            return False
+        if not isinstance(otherSet, SetOfImages):
+            return False
+        # This also loads the info of otherSet if opened from its file
+        otherShared = otherSet._useSharedInfo()
+        if otherShared and not self._useSharedInfo():
+            # The rows of otherSet do not store the sampling rate and
+            # acquisition, they are filled from its items (see _copyRows)
+            if otherSet.getSamplingRate() is None:
+                return False
+        if self.getSamplingRate() != otherSet.getSamplingRate():
+            return False
+        return (not self.hasAcquisition() or
+                self.getAcquisition().equalAttributes(otherSet.getAcquisition()))
+
     def _setFirstDim(self, image):
         """ Store dimensions when the first image is found.
         This function should be called only once, to avoid reading
@@ -1387,13 +1966,20 @@ class SetOfImages(EMSet):
 
     def writeStack(self, fnStack, orderBy='id', direction='ASC',
                    applyTransform=False):
-        # TODO create empty file to improve efficiency
         from pwem.emlib.image import ImageHandler
         ih = ImageHandler()
         applyTransform = applyTransform and self.hasAlignment2D()
+        imgIter = self.iterItems(orderBy=orderBy, direction=direction)
 
-        for i, img in enumerate(self.iterItems(orderBy=orderBy,
-                                               direction=direction)):
+        if not applyTransform and ih.isMrcLocation(fnStack):
+            # Allocate the output stack once and write it in a single pass
+            with ih.createStackWriter(fnStack, self.getSize(),
+                                      self.getSamplingRate() or 1.0) as writer:
+                for img in imgIter:
+                    writer.append(ih.readData(img))
+            return
+
+        for i, img in enumerate(imgIter):
             transform = img.getTransform() if applyTransform else None
             ih.convert(img, (i + 1, fnStack), transform=transform)
 
@@ -1453,9 +2039,17 @@ class SetOfImages(EMSet):
 
     def iterItems(self, orderBy='id', direction='ASC', where='1', limit=None, iterate=True):
         """ Redefine iteration to set the acquisition to images. """
-        for img in Set.iterItems(self, orderBy=orderBy, direction=direction,
-                                 where=where, limit=limit, iterate=iterate):
+        sharedInfo = self._useSharedInfo()
+
+        imgIter = Set.iterItems(self, orderBy=orderBy, direction=direction,
+                                where=where, limit=limit, iterate=iterate)
+
+        if sharedInfo:
+            for img in imgIter:
+                yield self._attachSetInfo(img)
+            return
 
+        for img in imgIter:
             # Sometimes the images items in the set could
             # have the acquisition info per data row and we
             # don't want to override with the set acquisition for this case
@@ -1463,6 +2057,18 @@ class SetOfImages(EMSet):
                 img.setAcquisition(self.getAcquisition())
             yield img
 
+    def __getitem__(self, itemId):
+        img = EMSet.__getitem__(self, itemId)
+        if img is not None and self._useSharedInfo():
+            self._attachSetInfo(img)
+        return img
+
+    def getFirstItem(self):
+        img = EMSet.getFirstItem(self)
+        if img is not None and self._useSharedInfo():
+            self._attachSetInfo(img)
+        return img
+
     def appendFromImages(self, imagesSet):
         """ Iterate over the images and append
         every image that is enabled.
@@ -1507,6 +2113,30 @@ class SetOfMicrographsBase(SetOfImages):
         else:
             self._scannedPixelSize.set(1e-4 * samplingRate * mag)
 
+    def append(self, micrograph):
+        """ Add a micrograph (or movie) to the set. The dimensions of its
+        file are stored with it (see Micrograph._getFileDimensions), so
+        they are not read again when the set is iterated. Only headers
+        that can be read in-process are read here, other formats are
+        read the first time getDim is called.
+        """
+        micrograph._storeFileDimensions(self._storesFileDimensions())
+        if micrograph._hasNativeHeader():
+            micrograph._getFileDimensions()
+        SetOfImages.append(self, micrograph)
+
+    def _storesFileDimensions(self):
+        """ Return True if the items store their file dimensions, i.e.
+        unless the set was created before they were stored. """
+        mapper = self._getMapper()
+        return mapper.doCreateTables or '_fileDim' in mapper.db._columnsMapping
+
+    def _canCopyRows(self, otherSet):
+        """ The file dimensions are different for each micrograph, so rows
+        can only be copied from sets that store them. """
+        return (SetOfImages._canCopyRows(self, otherSet) and
+                '_fileDim' in otherSet._getColumnClasses())
+
     def getScannedPixelSize(self):
         return self._scannedPixelSize.get()
 
@@ -1571,6 +2201,20 @@ class SetOfParticles(SetOfImages):
             self.copyAttributes(other, "_coordsPointer")
         self.setHasCTF(other.hasCTF())
 
+    def getTransforms(self, where=None):
+        """ Return the ids and the alignment matrices of the particles,
+        sorted by id, as an array of ids and a (N, 4, 4) array.
+        Particles without transform have a matrix full of NaN.
+        """
+        arrays = self.getArrays(['id', '_transform._matrix'], where=where)
+        return arrays['id'], arrays['_transform._matrix']
+
+    def setTransforms(self, ids, matrices):
+        """ Update the alignment matrices of the particles with the given
+        ids from a (N, 4, 4) array. Call write afterwards to commit.
+        """
+        self.setArrays(ids, {'_transform._matrix': matrices})
+
 
 class SetOfAverages(SetOfParticles):
     """Represents a set of Averages.
@@ -1827,6 +2471,51 @@ class SetOfCoordinates(EMSet):
         for coord in self.iterItems(where=coordWhere):
             yield coord
 
+    def iterCoordinatesByMicrograph(self, micIds=None, asArrays=False,
+                                    attributes=('id', '_x', '_y')):
+        """ Iterate over the coordinates grouped by micrograph, reading the
+        set only once sorted by micrograph (instead of a query per
+        micrograph as with iterCoordinates).
+        Params:
+            micIds: if not None, only the groups of these micrograph ids.
+            asArrays: if True, each group is a dict with an array per
+                attribute (see getArrays), otherwise a list of Coordinates.
+            attributes: attributes read when asArrays is True.
+        Returns:
+            an iterator of (micId, coordinates) sorted by micrograph id.
+        """
+        where = None
+        if micIds is not None:
+            micIds = set(micIds)
+            if not micIds:
+                return
+            # The mapper only understands simple comparisons in the where
+            where = '_micId>=%d AND _micId<=%d' % (min(micIds), max(micIds))
+
+        if asArrays:
+            if self._getMapper().db.missingTables():  # nothing appended yet
+                return
+            attributes = list(attributes)
+            arrays = self.getArrays(attributes + ['_micId'], where=where,
+                                    orderBy=['_micId', 'id'])
+            allMicIds = arrays.pop('_micId')
+            starts = np.flatnonzero(np.diff(allMicIds)) + 1
+            bounds = zip(np.concatenate(([0], starts)),
+                         np.concatenate((starts, [len(allMicIds)])))
+            for start, end in bounds:
+                if start == end:  # no rows
+                    continue
+                micId = int(allMicIds[start])
+                if micIds is None or micId in micIds:
+                    yield micId, {attr: arrays[attr][start:end]
+                                  for attr in attributes}
+        else:
+            coords = self.iterItems(orderBy=['_micId', 'id'], where=where)
+            for micId, micCoords in groupby(coords, lambda c: c.getMicId()):
+                if micIds is None or micId in micIds:
+                    # Items are reused while iterating, so keep clones
+                    yield micId, [coord.clone() for coord in micCoords]
+
     def getMicrographs(self):
         """ Returns the SetOfMicrographs associated with
         this SetOfCoordinates"""
@@ -1875,18 +2564,51 @@ class SetOfCoordinates(EMSet):
 
 
 class Matrix(Scalar):
+    """ 4x4 matrix stored as a single column.
+
+    By default the matrix is stored as a JSON string. When BINARY_ENCODING
+    is on (or SCIPION_MATRIX_BINARY is set) it is stored as a 128 bytes
+    little-endian float64 BLOB, which is faster to read and write and
+    takes less space. Both encodings are always readable.
+    """
+    BINARY_ENCODING = pwutils.envVarOn('SCIPION_MATRIX_BINARY')
+    BINARY_DTYPE = np.dtype('<f8')
+
     def __init__(self, **kwargs):
         Scalar.__init__(self, **kwargs)
         self._matrix = np.eye(4)
 
+    @classmethod
+    def setBinaryEncoding(cls, value):
+        """ Enable or disable the binary encoding for newly stored matrices. """
+        cls.BINARY_ENCODING = bool(value)
+
+    @classmethod
+    def decodeValue(cls, value):
+        """ Return the numpy matrix stored in value, either a str with
+        a JSON list of lists or the bytes of a binary encoded matrix.
+        """
+        if isinstance(value, (bytes, memoryview)):
+            data = np.frombuffer(value, dtype=cls.BINARY_DTYPE)
+            side = int(round(np.sqrt(data.size)))
+            return data.reshape(side, side).astype(float)
+        return np.array(json.loads(value))
+
+    @classmethod
+    def encodeValue(cls, matrix):
+        """ Return the value to be stored for a numpy matrix. """
+        if cls.BINARY_ENCODING and matrix.shape == (4, 4):
+            return np.ascontiguousarray(matrix, dtype=cls.BINARY_DTYPE).tobytes()
+        return json.dumps(matrix.tolist())
+
     def _convertValue(self, value):
-        """Value should be a str with comma separated values
-        or a list.
+        """Value should be a str with a JSON list of lists,
+        or the bytes of a binary encoded matrix.
         """
-        self._matrix = np.array(json.loads(value))
+        self._matrix = self.decodeValue(value)
 
     def getObjValue(self):
-        self._objValue = json.dumps(self._matrix.tolist())
+        self._objValue = self.encodeValue(self._matrix)
         return self._objValue
 
     def setValue(self, i, j, value):
@@ -2100,7 +2822,8 @@ class SetOfClasses(EMSet):
                       itemDataIterator=None,
                       classifyDisabled=False,
                       iterParams=None,
-                      doClone=True):
+                      doClone=True,
+                      batchSize=1000):
         """ Classify items from the self.getImages() and add the needed classes.
         This function iterates over each item in the images and call
         the updateItemCallback to register the information coming from
@@ -2115,6 +2838,8 @@ class SetOfClasses(EMSet):
         :param classifyDisabled: classify disabled items. By default they are skipped.
         :param iterParams: Parameters for self.getImages() to leave oot images/filter
         :param doClone: Make a clone of the item (defaults to true)
+        :param batchSize: the items of each class are inserted in batches of this size
+        (use 0 to insert them one by one). The classes are updated at the end.
         """
         itemDataIter = itemDataIterator  # shortcut
 
@@ -2122,39 +2847,44 @@ class SetOfClasses(EMSet):
         inputSet = self.getImages()
         iterParams = iterParams or {}
 
-        for item in inputSet.iterItems(**iterParams):
-            # copy items if enabled or copyDisabled=True
-            if classifyDisabled or item.isEnabled():
-                newItem = item.clone() if doClone else item
-                if updateItemCallback:
-                    row = None if itemDataIter is None else next(itemDataIter)
-                    updateItemCallback(newItem, row)
-                    # If updateCallBack function returns attribute
-                    # _appendItem to False do not append the item
-                    if not getattr(newItem, "_appendItem", True):
-                        continue
-                ref = newItem.getClassId()
-                if ref is None:
-                    raise Exception('Particle classId is None!!!')
-
-                # Register a new class set if the ref was not found.
-                # if not ref in clsDict:
-                if ref not in clsDict:
-                    classItem = self.ITEM_TYPE(objId=ref)
-                    rep = self.REP_TYPE()
-                    classItem.setRepresentative(rep)
-                    clsDict[ref] = classItem
-                    classItem.copyInfo(inputSet)
-                    classItem.setAcquisition(inputSet.getAcquisition())
-                    if updateClassCallback is not None:
-                        updateClassCallback(classItem)
-                    self.append(classItem)
+        try:
+            for item in inputSet.iterItems(**iterParams):
+                # copy items if enabled or copyDisabled=True
+                if classifyDisabled or item.isEnabled():
+                    newItem = item.clone() if doClone else item
+                    if updateItemCallback:
+                        row = None if itemDataIter is None else next(itemDataIter)
+                        updateItemCallback(newItem, row)
+                        # If updateCallBack function returns attribute
+                        # _appendItem to False do not append the item
+                        if not getattr(newItem, "_appendItem", True):
+                            continue
+                    ref = newItem.getClassId()
+                    if ref is None:
+                        raise Exception('Particle classId is None!!!')
+
+                    # Register a new class set if the ref was not found.
+                    # if not ref in clsDict:
+                    if ref not in clsDict:
+                        classItem = self.ITEM_TYPE(objId=ref)
+                        rep = self.REP_TYPE()
+                        classItem.setRepresentative(rep)
+                        clsDict[ref] = classItem
+                        classItem.copyInfo(inputSet)
+                        classItem.setAcquisition(inputSet.getAcquisition())
+                        if updateClassCallback is not None:
+                            updateClassCallback(classItem)
+                        self.append(classItem)
+                        classItem._setBulkSize(batchSize)
+                    else:
+                        classItem = clsDict[ref]
+                    classItem.append(newItem)
                 else:
-                    classItem = clsDict[ref]
-                classItem.append(newItem)
-            else:
-                if itemDataIter is not None:
-                    next(itemDataIter)  # just skip disabled data row
+                    if itemDataIter is not None:
+                        next(itemDataIter)  # just skip disabled data row
+        finally:
+            for classItem in clsDict.values():
+                classItem._setBulkSize(0)
 
         for classItem in clsDict.values():
             self.update(classItem)
@@ -2174,6 +2904,14 @@ class SetOfClasses2D(SetOfClasses):
                             'if not hasRepresentatives!!!')
         ih = ImageHandler()
 
+        if ih.isMrcLocation(fnStack):
+            # Allocate the output stack once and write it in a single pass
+            with ih.createStackWriter(fnStack, self.getSize(),
+                                      self.getSamplingRate() or 1.0) as writer:
+                for class2D in self:
+                    writer.append(ih.readData(class2D.getRepresentative()))
+            return
+
         for i, class2D in enumerate(self):
             img = class2D.getRepresentative()
             ih.convert(img, (i + 1, fnStack))
@@ -2311,10 +3049,8 @@ class Movie(Micrograph):
     def getDim(self):
         """Return image dimensions as tuple: (Xdim, Ydim, Zdim)
         Consider compressed Movie files"""
-        from pwem.emlib.image import ImageHandler
-
         if not self.isCompressed():
-            x, y, z, n = ImageHandler().getDimensions(self)
+            x, y, z, n = self._getFileDimensions()
             if x is not None:
                 return x, y, max(z, n)
         return None
@@ -2327,9 +3063,7 @@ class Movie(Micrograph):
             return last - first + 1
 
         if not self.isCompressed():
-            from pwem.emlib.image import ImageHandler
-
-            x, y, z, n = ImageHandler().getDimensions(self)
+            x, y, z, n = self._getFileDimensions()
             if x is not None:
                 return max(z, n)  # Protect against evil mrc files
         return None
@@ -35,6 +35,8 @@ except ImportError:
     izip = zip
 from math import ceil
 
+import numpy
+
 import pyworkflow.object as pwobj
 import pyworkflow.utils as pwutils
 from pyworkflow.gui.plotter import Plotter
@@ -571,14 +573,6 @@ class ProtAlignMovies(ProtProcessMovies):
         xmipp3 = Domain.importFromPlugin('xmipp3')
         xmipp3.Plugin.runXmippProgram(program, args)
 
-    def __runEman2Program(self, program, args):
-        """ Internal workaround to launch an EMAN2 program. """
-        from pwem import Domain
-        eman2 = Domain.importFromPlugin('eman2')
-        from pyworkflow.utils.process import runJob
-        runJob(self._log, eman2.Plugin.getProgram(program), args,
-               env=eman2.Plugin.getEnviron())
-
     def computePSD(self, inputMic, oroot, dim=384,  # 384 = 128 + 256, which should be fast for any Fourier Transformer
                    overlap=0.4):
         warnings.warn("Use psd = image.computePSD(overlap=0.4, xdim=384, ydim=384, fftthreads=1) instead",
@@ -642,16 +636,27 @@ class ProtAlignMovies(ProtProcessMovies):
     def computeThumbnail(self, inputFn, scaleFactor=6, outputFn=None):
         """ Generates a thumbnail of the input file"""
         outputFn = outputFn or self.getThumbnailFn(inputFn)
-        args = "%s %s " % (inputFn, outputFn)
-        args += "--meanshrink %s --fixintscaling=sane" % scaleFactor
-
-        self.__runEman2Program('e2proc2d.py', args)
+        ih = emlib.image.ImageHandler()
+        return ih.computeThumbnail(inputFn, outputFn, scaleFactor,
+                                   shrinkMethod=ih.SHRINK_MEAN)
+
+    def correctGain(self, movieFn, outputFn, gainFn=None, darkFn=None,
+                    chunkSize=16, samplingRate=None):
+        """correct a movie with both gain and dark images.
+        MRC movies are corrected with numpy, chunkSize frames at a time,
+        and the output stack is written in a single pass with samplingRate
+        (if None, the one of the input movies or else of the input file).
+        """
+        ih = emlib.image.ImageHandler()
+        if samplingRate is None:
+            # Set from the input movies in _insertAllSteps
+            samplingRate = getattr(self, 'samplingRate', None)
 
-        return outputFn
+        if ih.isMrcLocation(movieFn) and ih.isMrcLocation(outputFn):
+            self._correctGainMrc(ih, movieFn, outputFn, gainFn, darkFn,
+                                 chunkSize, samplingRate)
+            return
 
-    def correctGain(self, movieFn, outputFn, gainFn=None, darkFn=None):
-        """correct a movie with both gain and dark images"""
-        ih = emlib.image.ImageHandler()
         _, _, z, n = ih.getDimensions(movieFn)
         numberOfFrames = max(z, n)  # in case of wrong mrc stacks as volumes
 
@@ -678,6 +683,33 @@ class ProtAlignMovies(ProtProcessMovies):
 
             img.write((i, outputFn))
 
+    def _correctGainMrc(self, ih, movieFn, outputFn, gainFn, darkFn,
+                        chunkSize, samplingRate=None):
+        """ Numpy version of correctGain for MRC movies. The dark and gain
+        references are broadcast over blocks of chunkSize frames. """
+        def _readFloat(fn):
+            return ih.readData(fn).astype(numpy.float32) if fn else None
+
+        gain = _readFloat(gainFn)
+        dark = _readFloat(darkFn)
+        index, fn = ih._convertToLocation(movieFn)
+        header, data = ih._openMrc(fn)
+        data = ih._getMrcItem(header, data, index, fn)
+        frames = data.reshape((-1,) + data.shape[-2:])
+        numberOfFrames = frames.shape[0]
+        if not samplingRate:
+            samplingRate = ih._getMrcSampling(header)
+
+        with ih.createStackWriter(outputFn, numberOfFrames,
+                                  samplingRate) as writer:
+            for i in range(0, numberOfFrames, chunkSize):
+                block = frames[i:i + chunkSize].astype(numpy.float32)
+                if dark is not None:
+                    block -= dark
+                if gain is not None:
+                    block *= gain
+                writer.extend(block)
+
     def getThumbnailFn(self, inputFn):
         """ Returns the default name for a thumbnail image"""
         return pwutils.replaceExt(inputFn, "thumb.png")
@@ -25,9 +25,15 @@
 # **************************************************************************
 
 
+import bisect
+
+import numpy as np
+
 import pyworkflow.protocol.params as params
 from pyworkflow.object import Integer
 
+from pwem.objects import Transform
+
 from .protocol_2d import ProtAlign2D
 
 
@@ -69,54 +75,82 @@ class ProtAlignmentAssign(ProtAlign2D):
         update actions over each single item
         that will be stored in the output Set.
         """
-
-        alignedParticle = self.alignmentData[item.getObjId()]
+        index = self._findAlignment(item.getObjId())
         # If alignment is found for this particle set the alignment info
         # on the output particle, if not do not write that item
-        if alignedParticle is not None:
-            alignment = alignedParticle.getTransform()
+        if index is not None:
+            matrix = self.alignmentMatrices[index]
 
             # If shifts Applied before at extraction coordinate time
             if item.hasCoordinate() and hasattr(item.getCoordinate(), "xFrac"):
                 coord = item.getCoordinate()
-
-                # Useless: alignedParticle = inputAlignment[item.getObjId()]
-
+                alignment = Transform(np.copy(matrix))
                 alignment.invert()
                 alignment.setShifts(-coord.xFrac.get(),
                                 -coord.yFrac.get(),
                                 0)
                 alignment.invert()
             else:
-                alignment.scaleShifts(self.scale)
+                alignment = Transform(self.scaledMatrices[index])
 
             item.setTransform(alignment)
 
-            if self.assignRandomSubsets:
-                subset = \
-                    alignedParticle.getAttributeValue('_rlnRandomSubset', None)
-                if subset is not None:
-                    item._rlnRandomSubset = Integer(subset)
+            if self.randomSubsets is not None:
+                subset = self.randomSubsets[index]
+                if not np.isnan(subset):
+                    item._rlnRandomSubset = Integer(int(subset))
         else:
             item._appendItem = False
 
+    def _findAlignment(self, itemId):
+        """ Return the position of itemId in the sorted alignment ids, or
+        None if it has no alignment. The particles are copied by increasing
+        id, so both sets are walked in lockstep (merge join) and only the
+        ids after the last match are searched. If the order differs, all
+        ids are searched.
+        """
+        ids = self.alignmentIds
+        index = self._alignmentIndex
+        if index > 0 and ids[index - 1] >= itemId:
+            index = 0
+        if index < len(ids) and ids[index] != itemId:
+            index = bisect.bisect_left(ids, itemId, index)
+
+        if index < len(ids) and ids[index] == itemId:
+            self._alignmentIndex = index + 1
+            return index
+
+        self._alignmentIndex = index
+        return None
+
     def createOutputStep(self):
 
         inputParticles = self.inputParticles.get()
 
         # Store data to be used in the update item
         self.alignmentData = self.inputAlignment.get()
-
-        # Trigger the connection to avoid connecting and disconnecting later when using self.alignmentData[23]
-        self.alignmentData.load()
         self.scale = self.alignmentData.getSamplingRate()/inputParticles.getSamplingRate()
 
+        # Read all the alignment matrices at once (sorted by id) and
+        # scale their shifts with a single product
+        ids, self.alignmentMatrices = self.alignmentData.getTransforms()
+        self.alignmentIds = ids.tolist()
+        self.scaledMatrices = np.copy(self.alignmentMatrices)
+        self.scaledMatrices[:, :3, 3] *= self.scale
+
+        self.randomSubsets = None
+        if (self.assignRandomSubsets and '_rlnRandomSubset'
+                in self.alignmentData._getColumnClasses()):
+            self.randomSubsets = self.alignmentData.getArrays(
+                '_rlnRandomSubset')['_rlnRandomSubset']
+
         # Add alignment info from corresponding item on inputAlignment
         # Output
         outputParticles = self._createSetOfParticles()
         outputParticles.copyInfo(inputParticles)
         outputParticles.setAlignment(self.alignmentData.getAlignment())
 
+        self._alignmentIndex = 0
         outputParticles.copyItems(inputParticles,
                                   updateItemCallback=self._updateItem)
 
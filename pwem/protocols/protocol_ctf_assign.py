@@ -111,31 +111,42 @@ class ProtCTFAssign(ProtCTFMicrographs):
     #             print("ctf: ", ctf.printAll(), ctfName)
                 ctfDict[ctfName] = ctf.clone()
 
-            missingSet = set()  # Report missing micrographs only once
+            # Join the CTF columns with the particles rows in sqlite
+            keyAttr = '_coordinate._micName' if hasMicName else '_micId'
+            if outputParts.copyRowsByKey(inputSet, keyAttr, '_ctfModel', ctfDict):
+                for micKey in set(inputSet.getUniqueValues(keyAttr)) - set(ctfDict):
+                    self.warning("Discarding particles from micrograph with"
+                                 " micName: %s, CTF not found. " % micKey)
+            else:
+                self.__assignCTF(inputSet, outputParts, ctfDict, hasMicName)
 
-            for particle in inputSet:
-                if particle.hasCoordinate():
-                    coord = particle.getCoordinate()
-                    micKey = coord.getMicName() if hasMicName else particle.getMicId()
-                else:
-                    micKey = particle.getMicId()
-
-                if micKey not in missingSet:
-                    ctf = ctfDict.get(micKey, None)
-
-                    if ctf is None:
-                        self.warning("Discarding particles from micrograph with"
-                                     " micName: %s, CTF not found. " % micKey)
-                        missingSet.add(micKey)
-                    else:
-                        newParticle = particle.clone()
-                        newParticle.setCTF(ctf)
-                        outputParts.append(newParticle)
-        
         self._defineOutputs(outputParticles=outputParts)
         self._defineSourceRelation(self.inputSet, outputParts)
         self._defineSourceRelation(self.inputCTF, outputParts)
 
+    def __assignCTF(self, inputSet, outputSet, ctfDict, hasMicName):
+        """ Assign the CTFs item by item, when the rows can not be joined. """
+        missingSet = set()  # Report missing micrographs only once
+
+        for particle in inputSet:
+            if particle.hasCoordinate():
+                coord = particle.getCoordinate()
+                micKey = coord.getMicName() if hasMicName else particle.getMicId()
+            else:
+                micKey = particle.getMicId()
+
+            if micKey not in missingSet:
+                ctf = ctfDict.get(micKey, None)
+
+                if ctf is None:
+                    self.warning("Discarding particles from micrograph with"
+                                 " micName: %s, CTF not found. " % micKey)
+                    missingSet.add(micKey)
+                else:
+                    newParticle = particle.clone()
+                    newParticle.setCTF(ctf)
+                    outputSet.append(newParticle)
+
     def __findCTF(self, inputSet, outputSet, ctfDict, keyFunc):
         for mic in inputSet:
             micKey = keyFunc(mic)
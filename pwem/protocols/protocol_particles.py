@@ -406,14 +406,9 @@ class ProtExtractParticles(ProtParticles):
 
     def _loadInputCoords(self, micDict):
         """ Load coordinates from the input streaming.
+        The coordinates of all the new micrographs are read in a single
+        query, sorted by micrograph, instead of one query per micrograph.
         """
-        # TODO: this takes for ever if you are NOT
-        # doing streaming and have several thousands of mics
-        # so I add a counter to keep the user entertained
-        import sys
-        a = datetime.now()
-        counter = 1
-
         coordsFn = self.getCoords().getFileName()
         self.debug("Loading input db: %s" % coordsFn)
         coordSet = emobj.SetOfCoordinates(filename=coordsFn)
@@ -421,23 +416,16 @@ class ProtExtractParticles(ProtParticles):
         coordSet._xmippMd = pwobj.String()
         coordSet.loadAllProperties()
 
+        micIds = [mic.getObjId() for mic in micDict.values()]
+        micCoords = dict(coordSet.iterCoordinatesByMicrograph(micIds))
+
         micList = dict()  # To store a dictionary with mics with coordinates
 
         for micKey, mic in micDict.items():
-            if counter % 50 == 0:
-                b = datetime.now()
-                print(b - a, 'reading coordinates for mic number', "%06d" % counter)
-                sys.stdout.flush()  # force buffer to print
-            counter += 1
-
             micId = mic.getObjId()
-            coordList = []
-
-            self.debug("Loading coords for mic: %s (%s)" % (micId, micKey))
-            for coord in coordSet.iterItems(where='_micId=%s' % micId):
-                # TODO: Check performance penalty of using this clone
-                coordList.append(coord.clone())
-            self.debug("Coords found: %s" % len(coordList))
+            coordList = micCoords.get(micId, [])
+            self.debug("Coords found for mic %s (%s): %s"
+                       % (micId, micKey, len(coordList)))
 
             if coordList:
                 self.coordDict[micId] = coordList
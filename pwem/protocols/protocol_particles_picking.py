@@ -28,6 +28,9 @@ import os
 from datetime import datetime
 from collections import OrderedDict
 
+import numpy as np
+from scipy.spatial import cKDTree
+
 import pyworkflow.object as pwobj
 import pyworkflow.protocol.params as params
 import pyworkflow.protocol as pwprot
@@ -604,23 +607,31 @@ class ProtPickingDifference(ProtParticlePicking):
 
         r2 = radius * radius  # to avoid computing sqrt when comparing distances
 
-        def _discard(coord, negPos):
-            """ Find if there is a close negative particle to this one. """
-            x, y = coord.getPosition()
-
-            for nx, ny in negPos:
-                if abs((x - nx) * (y - ny)) < r2:
-                    return True
-
-            return False  # Far enough from all negative coordinates
-
-        # Read all consensus particles
-        for mic in inputMics:
-            negPos = [(c.getX(), c.getY())
-                      for c in negCoords.iterCoordinates(mic)]
-            for coord in inputCoords.iterCoordinates(mic):
-                if not _discard(coord, negPos):
-                    outputCoords.append(coord)
+        # Read the coordinates at once, grouped by micrograph
+        negGroups = {}
+        for micId, negs in negCoords.iterCoordinatesByMicrograph(
+                asArrays=True, attributes=['_x', '_y']):
+            negGroups[micId] = np.column_stack((negs['_x'], negs['_y']))
+
+        keepIds = set()
+        # Only coordinates from the input micrographs are kept
+        for micId, coords in inputCoords.iterCoordinatesByMicrograph(
+                micIds=inputMics.getIdSet(), asArrays=True):
+            keep = np.full(len(coords['id']), True, dtype=bool)
+            if micId in negGroups:
+                negPositions = negGroups[micId]
+                positions = np.column_stack((coords['_x'], coords['_y']))
+                # Find the closest negative coordinate of each one
+                _, nearest = cKDTree(negPositions).query(
+                    positions, distance_upper_bound=radius)
+                found = np.flatnonzero(nearest < len(negPositions))
+                diff = positions[found] - negPositions[nearest[found]]
+                keep[found[(diff * diff).sum(axis=1) < r2]] = False
+            keepIds.update(coords['id'][keep].tolist())
+
+        # The kept rows are copied in sqlite
+        outputCoords.copyItems(inputCoords, copyDisabled=True, doClone=False,
+                               itemIds=keepIds)
 
         # Set output
         self._defineOutputs(outputCoordinates=outputCoords)
@@ -278,14 +278,7 @@ class ProtProjectionEditor(EMProtocol):
         matrix = np.array(matrix)
         matrix = np.append(matrix, [[0, 0, 0, 1]], axis=0)
 
-        inputSet = self.inputSet.get()
-        modifiedSet = inputSet.createCopy(self._getExtraPath(), copyInfo=True)
-        for sourceItem in inputSet.iterItems():
-            item = sourceItem.clone()
-            transformation = item.getTransform()
-            transformation.composeTransform(matrix)
-            modifiedSet.append(item)
-        self.createOutput(self.inputSet, modifiedSet)
+        self.composeTransforms(matrix)
 
     def rotateDiStep(self):
         """ Compute rotation matrix from one dihedral
@@ -303,14 +296,7 @@ class ProtProjectionEditor(EMProtocol):
         matrix = np.array(matrix)
         matrix = np.append(matrix, [[0, 0, 0, 1]], axis=0)
 
-        inputSet = self.inputSet.get()
-        modifiedSet = inputSet.createCopy(self._getExtraPath(), copyInfo=True)
-        for sourceItem in inputSet.iterItems():
-            item = sourceItem.clone()
-            transformation = item.getTransform()
-            transformation.composeTransform(matrix)
-            modifiedSet.append(item)
-        self.createOutput(self.inputSet, modifiedSet)
+        self.composeTransforms(matrix)
 
     def rotateIcosaStep(self):
         """
@@ -330,13 +316,18 @@ class ProtProjectionEditor(EMProtocol):
         matrix = np.array(matrix)
         matrix = np.append(matrix, [[0, 0, 0, 1]], axis=0)
 
+        self.composeTransforms(matrix)
+
+    def composeTransforms(self, matrix):
+        """ Copy the input particles and compose all their
+        transformations with matrix in a single matrix product
+        """
         inputSet = self.inputSet.get()
         modifiedSet = inputSet.createCopy(self._getExtraPath(), copyInfo=True)
-        for sourceItem in inputSet.iterItems():
-            item = sourceItem.clone()
-            transformation = item.getTransform()
-            transformation.composeTransform(matrix)
-            modifiedSet.append(item)
+        modifiedSet.copyItems(inputSet, copyDisabled=True)
+        ids, matrices = modifiedSet.getTransforms()
+        modifiedSet.setTransforms(ids, np.matmul(matrix, matrices))
+        modifiedSet.write()
         self.createOutput(self.inputSet, modifiedSet)
 
     def createOutput(self, inputSet, modifiedSet):
@@ -357,15 +348,7 @@ class ProtProjectionEditor(EMProtocol):
         matrix = rotation_matrix(angle_between_vectors(v_source, v_target),
                                  vector_product(v_source, v_target))
         print("rotateStep:matrix", matrix)
-        inputSet = self.inputSet.get()
-        modifiedSet = inputSet.createCopy(self._getExtraPath(), copyInfo=True)
-        for sourceItem in inputSet.iterItems():
-            item = sourceItem.clone()
-            transformation = item.getTransform()
-            transformation.composeTransform(matrix)
-            modifiedSet.append(item)
-
-        self.createOutput(self.inputSet, modifiedSet)
+        self.composeTransforms(matrix)
 
     def rotateVectorStep(self):
         """
@@ -378,15 +361,7 @@ class ProtProjectionEditor(EMProtocol):
         angle = np.radians(self.angle.get())
         matrix = rotation_matrix(angle, v_source)
         print("matrix_rot_vector", matrix)
-        inputSet = self.inputSet.get()
-        modifiedSet = inputSet.createCopy(self._getExtraPath(), copyInfo=True)
-        for sourceItem in inputSet.iterItems():
-            item = sourceItem.clone()
-            transformation = item.getTransform()
-            transformation.composeTransform(matrix)
-            modifiedSet.append(item)
-
-        self.createOutput(self.inputSet, modifiedSet)
+        self.composeTransforms(matrix)
 
     def _validate(self):
         errors = []
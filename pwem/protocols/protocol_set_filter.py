@@ -29,6 +29,7 @@ import pyworkflow.protocol.params as params
 from pwem.protocols import EMProtocol
 from pwem.objects.data import SetOfCoordinates
 import numpy as np
+from scipy.spatial import cKDTree
 
 class ProtSetFilter(EMProtocol):
     """
@@ -157,38 +158,26 @@ class ProtSetFilter(EMProtocol):
         distance = self.distance.get() / sampling
         distance2 = distance * distance
 
-        # duplicate setOfCoordinates in memory
-        coordList = []
-        oldMicId=-1
-        # If coordenates are sorted by micId then
-        # we can process much faster
-        useBreak = True
-        for item in inputSet.iterItems():
-            micId = item.getMicId()
-            coordList.append([item.getX(), item.getY(), micId])
-            if oldMicId > micId:
-                useBreak = False
-            oldMicId = micId
-        keepList = np.full((len(inputSet)), True, dtype=bool)
-        # search for close coordinates
-        # this one remove both particles
-        for start1, coord1 in enumerate(coordList):
-            for start2, coord2 in enumerate(coordList[start1+1:]):
-                if (coord1[2] != coord2[2]):  # compare micIds
-                    if useBreak:
-                        break
-                    else:
-                        continue
-                xd = coord1[0] - coord2[0]
-                yd = coord1[1] - coord2[1]
-                if (xd*xd + yd*yd) < distance2:
-                    if keepFirstNot:
-                        keepList[start1] = False
-                    keepList[start2+start1+1] = False
+        # Read all the coordinates at once (grouped by micrograph and
+        # sorted by id) and look for the close pairs with a KD-tree
+        keepIds = set()
+        for micId, coords in inputSet.iterCoordinatesByMicrograph(asArrays=True):
+            positions = np.column_stack((coords['_x'], coords['_y']))
+            keep = np.full(len(positions), True, dtype=bool)
+            if len(positions) > 1:
+                pairs = cKDTree(positions).query_pairs(distance,
+                                                       output_type='ndarray')
+                # ids are sorted, so the first of each pair comes first
+                diff = positions[pairs[:, 0]] - positions[pairs[:, 1]]
+                close = pairs[(diff * diff).sum(axis=1) < distance2]
+                if keepFirstNot:
+                    keep[close[:, 0]] = False
+                keep[close[:, 1]] = False
+            keepIds.update(coords['id'][keep].tolist())
 
-        for condition, coord in zip(keepList, inputSet):
-            if condition:
-                modifiedSet.append(item)
+        # The kept rows are copied in sqlite
+        modifiedSet.copyItems(inputSet, copyDisabled=True, doClone=False,
+                              itemIds=keepIds)
 
         self.createOutput(modifiedSet)
 
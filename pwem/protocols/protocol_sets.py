@@ -31,9 +31,14 @@ This module contains protocols related to Set operations such us:
 ... etc
 """
 
+import os
 import random
+import sqlite3
 import sys
 
+import numpy as np
+from scipy.spatial import cKDTree
+
 import pyworkflow.protocol as pwprot
 import pyworkflow.object as pwobj
 
@@ -196,9 +201,22 @@ class ProtUnionSet(ProtSets):
 
         idsList = {}
         setNum = 0
+        # Duplicates are skipped comparing the original ids, that are lost
+        # when renumbering, so that case can not be done in sqlite
+        useRows = not (self.ignoreDuplicates.get() and self.renumber.get())
         for itemSet in self.inputSets:
             setNum += 1
             if str(itemSet.get().getClassName()) is not Volume.__name__:
+                newIds = (cleanIds and setNum > 1) or self.renumber.get()
+                if (useRows and not self.ignoreExtraAttributes and
+                        outputSet.appendRows(itemSet.get(), newIds=newIds,
+                                             skipDuplicates=self.ignoreDuplicates.get())):
+                    idsList = None  # the appended ids are in the output set
+                    continue
+
+                if idsList is None:
+                    idsList = {objId: objId for objId in outputSet.getIdSet()}
+
                 for obj in itemSet.get():
                     objId = obj.getObjId()
                     if self.ignoreDuplicates.get():
@@ -224,6 +242,8 @@ class ProtUnionSet(ProtSets):
             else:
                 obj = itemSet.get()
                 objId = obj.getObjId()
+                if idsList is None:
+                    idsList = {objId: objId for objId in outputSet.getIdSet()}
                 if self.ignoreDuplicates.get():
                     if objId in idsList:
                         continue
@@ -263,19 +283,39 @@ class ProtUnionSet(ProtSets):
 
     def duplicatedIds(self):
         """ Check if there are duplicated ids to renumber from
-        the beginning. """
-        usedIds = set()  # to keep track of the object ids we have already seen
-
-        for item_pointer in self.inputSets:
-            if str(item_pointer.get().getClassName()) is not Volume.__name__:
-                for objId in item_pointer.get().getIdSet():
-                    if objId in usedIds:
-                        return True
-            else:
-                objId = item_pointer.get().getObjId()
-                if objId in usedIds:
-                    return True
-            usedIds.add(objId)
+        the beginning. The ids of the sets are inserted in a temporary
+        sqlite table, where a duplicated primary key makes the insert fail.
+        """
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE ids (id INTEGER PRIMARY KEY)")
+
+        try:
+            for item_pointer in self.inputSets:
+                itemSet = item_pointer.get()
+                if str(itemSet.getClassName()) is Volume.__name__:
+                    conn.execute("INSERT INTO ids VALUES (?)",
+                                 (itemSet.getObjId(),))
+                    continue
+
+                db = itemSet._getMapper().db
+                dbName = getattr(db, 'getDbName', lambda: None)()
+                if (isinstance(itemSet, EMSet) and dbName and
+                        os.path.exists(dbName) and not db.missingTables()):
+                    conn.execute("ATTACH DATABASE ? AS src", (dbName,))
+                    try:
+                        conn.execute("INSERT INTO ids SELECT id FROM src.%sObjects"
+                                     % db.tablePrefix)
+                    finally:
+                        conn.commit()
+                        conn.execute("DETACH DATABASE src")
+                else:
+                    conn.executemany("INSERT INTO ids VALUES (?)",
+                                     ((objId,) for objId in itemSet.getIdSet()))
+        except sqlite3.IntegrityError:
+            return True
+        finally:
+            conn.close()
+
         return False
 
     def getAllSetsAttributes(self):
@@ -579,6 +619,13 @@ class ProtSubSet(ProtSets):
                 self.info("Creating subset by range: %s" % self.range)
                 ids = set(getListFromRangeString(self.range.get()))
         else:
+            difference = self.setOperation != self.SET_INTERSECTION
+            # Try to join both sets in sqlite, copying the matching rows
+            if outputSet.copyRowsById(inputFullSet, self.inputSubSet.get(),
+                                      difference=difference):
+                self._defineSubSetOutput(inputFullSet, outputSet)
+                return
+
             # Get the ids from both sets
             fullSetIds = inputFullSet.getIdSet()
             smallSetIds = self.inputSubSet.get().getIdSet()
@@ -614,6 +661,11 @@ class ProtSubSet(ProtSets):
         if progress:
             progress.finish(printNewLine=True)
 
+        self._defineSubSetOutput(inputFullSet, outputSet)
+
+    def _defineSubSetOutput(self, inputFullSet, outputSet):
+        inputClassName = inputFullSet.getClassName()
+
         if outputSet.getSize():
             key = 'output' + inputClassName.replace('SetOf', '')
             self._defineOutputs(**{key: outputSet})
@@ -819,24 +871,36 @@ class ProtSubSetByCoord(ProtSets):
         outputSet = self._createSetOfParticles()
         outputSet.copyInfo(inputParticles)
 
+        # Index the coordinates of each micrograph with a KD-tree, in the
+        # max-norm: both the X and Y distances must be within the tolerance
         micCoordinates = {}
-        for coord in inputCoordinates.iterCoordinates():
-            micId = coord.getMicId()
-            x, y = coord.getPosition()
-            if micId not in micCoordinates:
-                micCoordinates[micId] = []
-            micCoordinates[micId].append((x, y))
-
-        for particle in inputParticles:
-            if particle.getMicId() in micCoordinates:
-                x0, y0 = particle.getCoordinate().getPosition()
-                okToAdd = False
-                for x, y in micCoordinates[particle.getMicId()]:
-                    if abs(x - x0) <= tolerance and abs(y - y0) <= tolerance:
-                        okToAdd = True
-                        break
-                if okToAdd:
-                    outputSet.append(particle)
+        for micId, coords in inputCoordinates.iterCoordinatesByMicrograph(
+                asArrays=True, attributes=['_x', '_y']):
+            micCoordinates[micId] = np.column_stack((coords['_x'], coords['_y']))
+
+        parts = inputParticles.getArrays(['id', '_micId', '_coordinate._x',
+                                          '_coordinate._y'])
+        partMicIds = parts['_micId']
+        positions = np.column_stack((parts['_coordinate._x'],
+                                     parts['_coordinate._y']))
+        okToAdd = np.full(len(partMicIds), False, dtype=bool)
+
+        order = np.argsort(partMicIds, kind='stable')
+        for indexes in np.split(order, np.flatnonzero(np.diff(partMicIds[order])) + 1):
+            if len(indexes) == 0 or partMicIds[indexes[0]] not in micCoordinates:
+                continue
+            micPositions = micCoordinates[partMicIds[indexes[0]]]
+            _, nearest = cKDTree(micPositions).query(
+                positions[indexes], p=np.inf,
+                distance_upper_bound=np.nextafter(tolerance, np.inf))
+            found = nearest < len(micPositions)
+            indexes = indexes[found]
+            diff = np.abs(positions[indexes] - micPositions[nearest[found]])
+            okToAdd[indexes[(diff <= tolerance).all(axis=1)]] = True
+
+        # The selected rows are copied in sqlite
+        outputSet.copyItems(inputParticles, copyDisabled=True, doClone=False,
+                            itemIds=parts['id'][okToAdd].tolist())
 
         self._defineOutputs(outputParticles=outputSet)
         self._defineTransformRelation(inputParticles, outputSet)
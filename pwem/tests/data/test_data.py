@@ -6,7 +6,7 @@ Created on May 20, 2013
 
 from glob import iglob
 import sqlite3
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import numpy as np
 
@@ -20,6 +20,7 @@ from pwem.emlib import metadata as md
 import pwem.protocols as emprot
 import pyworkflow.tests as pwtests
 from pwem.convert import SequenceHandler
+from pwem.convert.headers import Ccp4Header
 
 # set to true if you want to check how fast is the access to
 # the database
@@ -400,6 +401,396 @@ class TestImageHandler(unittest.TestCase):
         self.assertEqual(ih.getDataType(outFn), DT)
 
 
+class TestMrcImageHandler(unittest.TestCase):
+    """ Test the native numpy MRC backend with synthetic stacks. """
+    _labels = [SMALL, WEEKLY]
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.stack = np.random.rand(5, 16, 12).astype(np.float32)
+        cls.stackFn = join(cls.outputPath, 'stack.mrcs')
+        emlib.image.ImageHandler.writeMrc(cls.stack, cls.stackFn)
+
+    def test_readWrite(self):
+        ih = emlib.image.ImageHandler()
+        self.assertEqual(ih.getDimensions(self.stackFn), (12, 16, 1, 5))
+
+        # Random access to a single slice
+        img = ih.readMrc((3, self.stackFn))
+        self.assertEqual(img.shape, (16, 12))
+        self.assertTrue(np.allclose(img, self.stack[2]))
+
+        # Stacks of volumes
+        volumes = np.random.rand(3, 4, 5, 6).astype(np.float32)
+        volumesFn = join(self.outputPath, 'volumes.mrc')
+        ih.writeMrc(volumes, volumesFn)
+        self.assertEqual(ih.getDimensions(volumesFn), (6, 5, 4, 3))
+        self.assertTrue(np.allclose(ih.readMrc((2, volumesFn)), volumes[1]))
+
+    def test_convert(self):
+        ih = emlib.image.ImageHandler()
+        outFn = join(self.outputPath, 'converted.mrcs')
+        pwutils.cleanPath(outFn)
+
+        # Writing with an index enlarges the output stack when needed
+        ih.convert((2, self.stackFn), (1, outFn))
+        ih.convert((4, self.stackFn), (3, outFn))
+        self.assertEqual(ih.getDimensions(outFn), (12, 16, 1, 3))
+        self.assertTrue(np.allclose(ih.readMrc((1, outFn)), self.stack[1]))
+        self.assertTrue(np.allclose(ih.readMrc((3, outFn)), self.stack[3]))
+        self.assertFalse(ih.readMrc((2, outFn)).any())
+
+        # Whole stack to a volume with a different data type
+        volFn = join(self.outputPath, 'volume.mrc')
+        ih.convert(self.stackFn, volFn, dataType=np.float16)
+        self.assertEqual(ih.getDimensions(volFn), (12, 16, 5, 1))
+        self.assertEqual(ih.readMrc(volFn).dtype, np.float16)
+
+        # Sampling and origin of the input are kept
+        sampledFn = join(self.outputPath, 'sampled.mrcs')
+        ih.writeMrc(self.stack, sampledFn, sampling=2.5,
+                    origin=(10., -5., 0.))
+        for index, outFn in [(emobj.NO_INDEX, 'sampled_image.mrc'),
+                             (1, 'sampled_new.mrcs')]:
+            outFn = join(self.outputPath, outFn)
+            pwutils.cleanPath(outFn)
+            ih.convert((2, sampledFn), (index, outFn))
+            header = Ccp4Header(outFn, readHeader=True)
+            self.assertAlmostEqual(header.getSampling()[0], 2.5)
+            self.assertEqual(header.getOrigin(), (10., -5., 0.))
+
+    def test_writeStack(self):
+        ih = emlib.image.ImageHandler()
+        partSet = emobj.SetOfParticles(
+            filename=join(self.outputPath, 'particles.sqlite'))
+        partSet.setSamplingRate(2.0)
+        # Write the images in reverse order to a new stack
+        for i in range(5, 0, -1):
+            partSet.append(emobj.Particle(location=(i, self.stackFn)))
+
+        outFn = join(self.outputPath, 'written.mrcs')
+        partSet.writeStack(outFn, orderBy='id', direction='DESC')
+        self.assertEqual(ih.getDimensions(outFn), (12, 16, 1, 5))
+        self.assertTrue(np.allclose(ih.readMrc(outFn)[:, 0], self.stack))
+        header = Ccp4Header(outFn, readHeader=True)
+        self.assertAlmostEqual(header.getSampling()[0], 2.0)
+
+    def test_correctGain(self):
+        ih = emlib.image.ImageHandler()
+        movie = np.random.rand(5, 16, 12).astype(np.float32)
+        gain = np.random.rand(16, 12).astype(np.float32) + 0.5
+        dark = np.random.rand(16, 12).astype(np.float32)
+        movieFn = join(self.outputPath, 'gain_movie.mrcs')
+        gainFn = join(self.outputPath, 'gain.mrc')
+        darkFn = join(self.outputPath, 'dark.mrc')
+        ih.writeMrc(movie, movieFn, sampling=1.5)
+        ih.writeMrc(gain, gainFn)
+        ih.writeMrc(dark, darkFn)
+
+        prot = emprot.ProtAlignMovies()
+        for samplingRate, expected in [(None, 1.5), (0.75, 0.75)]:
+            outFn = join(self.outputPath, 'gain_corrected.mrcs')
+            pwutils.cleanPath(outFn)
+            prot.correctGain(movieFn, outFn, gainFn=gainFn, darkFn=darkFn,
+                             chunkSize=2, samplingRate=samplingRate)
+            self.assertTrue(np.allclose(ih.readMrc(outFn)[:, 0],
+                                        (movie - dark) * gain))
+            header = Ccp4Header(outFn, readHeader=True)
+            self.assertAlmostEqual(header.getSampling()[0], expected)
+
+        # ProtProcessMovies calls it without samplingRate, the one of
+        # the input movies is used
+        prot.samplingRate = 2.
+        prot.correctGain(movieFn, outFn, gainFn=gainFn, darkFn=darkFn)
+        header = Ccp4Header(outFn, readHeader=True)
+        self.assertAlmostEqual(header.getSampling()[0], 2.)
+
+    def test_computeAverage(self):
+        ih = emlib.image.ImageHandler()
+        expected = self.stack.mean(axis=0)
+        serial = ih.computeAverage(self.stackFn)
+        self.assertTrue(np.allclose(serial.getData(), expected, atol=1e-6))
+
+        parallel = ih.computeAverage(self.stackFn, numberOfThreads=3,
+                                     chunkSize=1)
+        self.assertTrue(np.allclose(parallel.getData(), expected, atol=1e-6))
+
+        partSet = emobj.SetOfParticles(
+            filename=join(self.outputPath, 'particles_avg.sqlite'))
+        for i in range(1, 6):
+            partSet.append(emobj.Particle(location=(i, self.stackFn)))
+        setAverage = ih.computeAverage(partSet, numberOfThreads=2)
+        self.assertTrue(np.allclose(setAverage.getData(), expected, atol=1e-6))
+
+    def test_computeThumbnail(self):
+        from PIL import Image
+        ih = emlib.image.ImageHandler()
+        micFn = join(self.outputPath, 'mic.mrc')
+        ih.writeMrc(np.random.rand(120, 96).astype(np.float32), micFn)
+
+        thumbFn = ih.computeThumbnail(micFn, None)
+        self.assertEqual(thumbFn, join(self.outputPath, 'mic.thumb.png'))
+        self.assertEqual(Image.open(thumbFn).size, (16, 20))
+
+        outFns = [join(self.outputPath, 'mic_%d.jpg' % i) for i in range(2)]
+        thumbFns = ih.computeThumbnails([micFn, micFn], outFns,
+                                        numberOfThreads=2, scaleFactor=4,
+                                        shrinkMethod=ih.SHRINK_MEAN)
+        self.assertEqual(thumbFns, outFns)
+        for fn in outFns:
+            self.assertEqual(Image.open(fn).size, (24, 30))
+
+    def test_computeThumbnailFlip(self):
+        from PIL import Image
+        ih = emlib.image.ImageHandler()
+        # Asymmetric image: a single bright pixel in the first row and column
+        data = np.zeros((6, 8), dtype=np.float32)
+        data[0, 0] = 1.
+        micFn = join(self.outputPath, 'asym.mrc')
+        ih.writeMrc(data, micFn)
+
+        def _brightest(suffix, **kwargs):
+            thumbFn = join(self.outputPath, 'asym_%s.png' % suffix)
+            ih.computeThumbnail(micFn, thumbFn, scaleFactor=1, **kwargs)
+            thumb = np.asarray(Image.open(thumbFn))
+            return np.unravel_index(np.argmax(thumb), thumb.shape)
+
+        self.assertEqual(_brightest('none'), (0, 0))
+        # xform.flip:axis=y is a vertical flip and axis=x an horizontal one
+        self.assertEqual(_brightest('y', flipOnY=True), (5, 0))
+        self.assertEqual(_brightest('x', flipOnX=True), (0, 7))
+        self.assertEqual(_brightest('xy', flipOnY=True, flipOnX=True), (5, 7))
+
+    def test_fixFile(self):
+        ih = emlib.image.ImageHandler()
+        volume = np.random.rand(8, 10, 12).astype(np.float32)
+        volFn = join(self.outputPath, 'to_fix.mrc')
+        ih.writeMrc(volume, volFn)
+        self.assertTrue(Ccp4Header.isPlainMrc(volFn))
+
+        for headerOnly in [True, False]:
+            outFn = join(self.outputPath, 'fixed_%s.mrc' % headerOnly)
+            Ccp4Header.fixFile(volFn + ':mrc', outFn, (-6., -5., -4.),
+                               sampling=2., originField=Ccp4Header.ORIGIN,
+                               headerOnly=headerOnly)
+            header = Ccp4Header(outFn, readHeader=True)
+            self.assertEqual(header.getSampling(), (2., 2., 2.))
+            self.assertEqual(header.getOrigin(), (-6., -5., -4.))
+            self.assertEqual(ih.getDimensions(outFn), (12, 10, 8, 1))
+            self.assertTrue(np.allclose(ih.readMrc(outFn), volume))
+
+    def test_editHeaders(self):
+        from pwem.convert.headers import (editMRCHeaders, fixVolume,
+                                          setMRCSamplingRate)
+        ih = emlib.image.ImageHandler()
+        fns = [join(self.outputPath, 'edit_%d.mrc' % i) for i in range(3)]
+        for fn in fns:
+            ih.writeMrc(np.ones((4, 6, 8), dtype=np.float32), fn)
+
+        # All files are already volumes
+        self.assertEqual(fixVolume(fns), fns)
+        self.assertEqual(setMRCSamplingRate(fns[1:], 3.), [])
+        self.assertEqual(setMRCSamplingRate(fns, 3.), fns[1:])
+        self.assertEqual(editMRCHeaders(fns, origin=(1., 2., 3.),
+                                        samplingRate=3.), [])
+        for fn in fns:
+            header = Ccp4Header(fn, readHeader=True)
+            self.assertEqual(header.getSampling(), (3., 3., 3.))
+            self.assertEqual(header.getOrigin(), (1., 2., 3.))
+            self.assertTrue(np.allclose(ih.readMrc(fn), 1.))
+
+    def test_scaleFourier(self):
+        ih = emlib.image.ImageHandler()
+
+        def _wave(dim):
+            y, x = np.mgrid[0:dim, 0:dim]
+            return (np.cos(2 * np.pi * 3 * x / dim) +
+                    np.sin(2 * np.pi * 5 * y / dim))
+
+        # Band limited images are kept when cropping in Fourier space
+        stackFn = join(self.outputPath, 'waves.mrcs')
+        ih.writeMrc(np.stack([_wave(64)] * 4).astype(np.float32), stackFn)
+        outFn = join(self.outputPath, 'waves_scaled.mrcs')
+        ih.scaleFourier(stackFn, outFn, 2)
+        self.assertEqual(ih.getDimensions(outFn), (32, 32, 1, 4))
+        self.assertTrue(np.allclose(ih.readMrc((3, outFn)), _wave(32),
+                                    atol=1e-5))
+
+        # and when padding
+        outFn = join(self.outputPath, 'waves_scaled.mrc')
+        ih.scale2DStack(stackFn, outFn, finalDimension=128)
+        self.assertEqual(ih.getDimensions(outFn), (128, 128, 4, 1))
+        self.assertTrue(np.allclose(ih.readMrc((1, outFn)), _wave(128),
+                                    atol=1e-5))
+
+        volFn = join(self.outputPath, 'random_volume.mrc')
+        ih.writeMrc(np.random.rand(16, 16, 16).astype(np.float32), volFn)
+        outFn = join(self.outputPath, 'random_volume_scaled.mrc')
+        ih.scaleFourier(volFn, outFn, 0.5)
+        self.assertEqual(ih.getDimensions(outFn), (32, 32, 32, 1))
+
+
+class TestTiffImageHandler(unittest.TestCase):
+    """ Test tiff dimensions with synthetic movies. """
+    _labels = [SMALL, WEEKLY]
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_getDimensions(self):
+        import tifffile
+        ih = emlib.image.ImageHandler()
+        movie = np.random.randint(0, 255, (30, 64, 48)).astype(np.uint8)
+        movieFn = join(self.outputPath, 'movie.tif')
+        bigMovieFn = join(self.outputPath, 'movie_big.tif')
+        tifffile.imwrite(movieFn, movie)
+        tifffile.imwrite(bigMovieFn, movie[:7], bigtiff=True)
+
+        self.assertEqual(ih.getDimensions(movieFn), (64, 48, 30, 1))
+        self.assertEqual(ih.getDimensions(bigMovieFn), (64, 48, 7, 1))
+
+        # Cached dimensions are refreshed when the file changes
+        tifffile.imwrite(movieFn, movie[:10])
+        os.utime(movieFn, (0, 0))
+        self.assertEqual(ih.getDimensions(movieFn), (64, 48, 10, 1))
+
+
+class TestMicrographDim(unittest.TestCase):
+    """ Test the dimensions cached in micrographs and movies. """
+    _labels = [SMALL, WEEKLY]
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_cachedDim(self):
+        ih = emlib.image.ImageHandler()
+        movieFn = join(self.outputPath, 'movie.mrcs')
+        ih.writeMrc(np.zeros((6, 20, 10), dtype=np.float32), movieFn)
+
+        movie = emobj.Movie(location=movieFn)
+        self.assertEqual(movie.getDim(), (10, 20, 6))
+        self.assertEqual(movie.getNumberOfFrames(), 6)
+
+        # Cached dimensions are stored with the movie
+        movieSet = emobj.SetOfMovies(
+            filename=join(self.outputPath, 'movies.sqlite'))
+        movieSet.append(movie)
+        movieSet.write()
+        movie2 = movieSet.getFirstItem()
+        self.assertEqual(list(movie2._fileDim), [10, 20, 1, 6])
+
+        # and refreshed when the file changes
+        ih.writeMrc(np.zeros((4, 20, 10), dtype=np.float32), movieFn)
+        os.utime(movieFn, (0, 0))
+        self.assertEqual(movie2.getNumberOfFrames(), 4)
+        movieSet.close()
+
+        # or when the movie points to a different file
+        movie.setFileName(join(self.outputPath, 'missing.mrcs'))
+        self.assertTrue(movie._fileDim.isEmpty())
+
+    def test_dimOnAppend(self):
+        """ Dimensions are stored when the micrographs are appended, so
+        the items read back from the set do not read the headers. """
+        ih = emlib.image.ImageHandler()
+        micSet = emobj.SetOfMicrographs(
+            filename=join(self.outputPath, 'micrographs_dim.sqlite'))
+        for i in range(1, 4):
+            micFn = join(self.outputPath, 'mic_dim_%d.mrc' % i)
+            ih.writeMrc(np.zeros((10 * i, 8), dtype=np.float32), micFn)
+            micSet.append(emobj.Micrograph(location=micFn))
+        micSet.append(emobj.Micrograph(
+            location=join(self.outputPath, 'missing.mrc')))
+        micSet.write()
+        micSet.close()
+
+        micSet = emobj.SetOfMicrographs(
+            filename=join(self.outputPath, 'micrographs_dim.sqlite'))
+        with mock.patch.object(emlib.image.ImageHandler, 'getDimensions',
+                               side_effect=AssertionError('header read')):
+            dims = [mic.getDim() for mic in micSet.iterItems(where='id<4')]
+        self.assertEqual(dims, [(8, 10 * i, 1) for i in range(1, 4)])
+        self.assertIsNone(micSet[4].getDim())
+        micSet.close()
+
+    def test_dimOnlyInMicrographSets(self):
+        """ Nested micrographs (e.g. of a CTF) do not store the dimensions,
+        while the items read from a set of micrographs keep them when
+        updated or appended again. """
+        ih = emlib.image.ImageHandler()
+        micFns = [join(self.outputPath, 'mic_nested_%d.mrc' % i)
+                  for i in range(1, 4)]
+        for i, micFn in enumerate(micFns, 1):
+            ih.writeMrc(np.zeros((10 * i, 8), dtype=np.float32), micFn)
+
+        setFn = join(self.outputPath, 'micrographs_nested.sqlite')
+        micSet = emobj.SetOfMicrographs(filename=setFn)
+        for micFn in micFns[:2]:
+            micSet.append(emobj.Micrograph(location=micFn))
+        micSet.write()
+        micSet.close()
+
+        micSet = emobj.SetOfMicrographs(filename=setFn)
+        micSet.enableAppend()
+        mic = micSet[1]
+        mic.setMicName('first')
+        micSet.update(mic)
+        micSet.append(emobj.Micrograph(location=micFns[2]))
+        micSet.write()
+        micSet.close()
+
+        micSet = emobj.SetOfMicrographs(filename=setFn)
+        self.assertEqual([(m.getMicName(), list(m._fileDim))
+                          for m in micSet.iterItems()],
+                         [('first', [8, 10, 1, 1]), (None, [8, 20, 1, 1]),
+                          (None, [8, 30, 1, 1])])
+
+        partSet = emobj.SetOfParticles(
+            filename=join(self.outputPath, 'particles_nested.sqlite'))
+        partSet.setSamplingRate(1.)
+        ctf = emobj.CTFModel(defocusU=10000, defocusV=10000, defocusAngle=0)
+        ctf.setMicrograph(micSet[2])
+        part = emobj.Particle(location=(1, 'particles.mrcs'))
+        part.setCTF(ctf)
+        partSet.append(part)
+        micSet.close()
+        self.assertFalse([column for column in partSet._getColumnClasses()
+                          if '_fileDim' in column or '_fileMTime' in column])
+        partSet.close()
+
+    def test_noExternalReadOnAppend(self):
+        """ Headers that need xmipp or an external program (e.g. EMAN2 for
+        .img) and compressed movies are not read when appended, apart from
+        the first image dimensions stored in the set. """
+        movieSet = emobj.SetOfMovies(
+            filename=join(self.outputPath, 'movies_external.sqlite'))
+        micSet = emobj.SetOfMicrographs(
+            filename=join(self.outputPath, 'micrographs_external.sqlite'))
+        with mock.patch.object(emlib.image.ImageHandler, 'getDimensions',
+                               return_value=(8, 8, 1, 1)) as getDimensions:
+            for fn in ['movie.mrcs.bz2', 'movie.tbz']:
+                movieFn = join(self.outputPath, fn)
+                open(movieFn, 'w').close()
+                movieSet.append(emobj.Movie(location=movieFn))
+            self.assertEqual(getDimensions.call_count, 0)
+            for i in range(3):
+                micFn = join(self.outputPath, 'mic_%d.img' % i)
+                open(micFn, 'w').close()
+                micSet.append(emobj.Micrograph(location=micFn))
+            self.assertEqual(getDimensions.call_count, 1)
+        self.assertEqual(movieSet.getSize(), 2)
+        self.assertEqual(micSet.getSize(), 3)
+        for movie in movieSet:
+            self.assertTrue(movie._fileDim.isEmpty())
+        for mic in micSet.iterItems(where='id>1'):
+            self.assertTrue(mic._fileDim.isEmpty())
+        movieSet.close()
+        micSet.close()
+
+
 class TestSetOfMicrographs(BaseTest):
     _labels = [SMALL, WEEKLY]
 
@@ -787,6 +1178,44 @@ class TestSetOfCoordinates(BaseTest):
                 coordList.append(coord.clone())
             testTimer.toc("Loop with NO INDEX but proper code, took:")
 
+    def test_iterCoordinatesByMicrograph(self):
+        """ Check the coordinates grouped by micrograph, as lists of
+        coordinates and as arrays. """
+        fn = self.getOutputPath('coordinates_grouped.sqlite')
+        coordSet = emobj.SetOfCoordinates(filename=fn)
+        self.assertEqual(list(coordSet.iterCoordinatesByMicrograph(
+            asArrays=True)), [])
+
+        coord = emobj.Coordinate()
+        for i in range(30):
+            # Coordinates of micrographs 3, 5 and 7 mixed up
+            coord.setPosition(i, 2 * i)
+            coord.setMicId(3 + 2 * (i % 3))
+            coordSet.append(coord)
+            coord.cleanObjId()
+        coordSet.write()
+
+        expected = {micId: [c.getObjId() for c in
+                            coordSet.iterCoordinates(micId)]
+                    for micId in [3, 5, 7]}
+
+        groups = list(coordSet.iterCoordinatesByMicrograph())
+        self.assertEqual([micId for micId, _ in groups], [3, 5, 7])
+        for micId, coords in groups:
+            self.assertEqual([c.getObjId() for c in coords], expected[micId])
+            self.assertTrue(all(c.getMicId() == micId for c in coords))
+
+        groups = list(coordSet.iterCoordinatesByMicrograph(micIds=[7, 3],
+                                                           asArrays=True))
+        self.assertEqual([micId for micId, _ in groups], [3, 7])
+        for micId, arrays in groups:
+            self.assertEqual(arrays['id'].tolist(), expected[micId])
+            self.assertEqual((arrays['_y'] - 2 * arrays['_x']).tolist(),
+                             [0] * 10)
+
+        self.assertEqual(list(coordSet.iterCoordinatesByMicrograph(
+            micIds=[4])), [])
+
 
 class TestSetOfClasses2D(BaseTest):
     _labels = [SMALL, WEEKLY]
@@ -865,6 +1294,10 @@ class TestSetOfClasses2D(BaseTest):
 
 class TestTransform(BaseTest):
 
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
     def test_scale(self):
         """ Check Scale storage in transformation class
         """
@@ -917,6 +1350,121 @@ class TestTransform(BaseTest):
         m3 = p2.getTransform().getMatrix()
         self.assertTrue(np.allclose(m, m3, rtol=1e-2))
 
+    def test_binaryEncoding(self):
+        """ Check that json and binary encoded matrices can be stored
+        in the same set and are read back unchanged.
+        """
+        fn = self.getOutputPath('particles_matrix.sqlite')
+        partSet = emobj.SetOfParticles(filename=fn)
+        matrices = []
+        binaryEncoding = emobj.Matrix.BINARY_ENCODING
+
+        try:
+            for i in range(10):
+                emobj.Matrix.setBinaryEncoding(i >= 5)
+                m = np.random.rand(4, 4)
+                matrices.append(m)
+                p = emobj.Particle(location=(i + 1, 'particles.mrcs'))
+                p.setTransform(emobj.Transform(m))
+                value = p.getTransform()._matrix.getObjValue()
+                self.assertIsInstance(value, bytes if i >= 5 else str)
+                partSet.append(p)
+            partSet.write()
+            partSet.close()
+        finally:
+            emobj.Matrix.setBinaryEncoding(binaryEncoding)
+
+        partSet = emobj.SetOfParticles(filename=fn)
+        for m, p in zip(matrices, partSet):
+            mRead = p.getTransform().getMatrix()
+            self.assertTrue(np.array_equal(m, mRead))
+            mRead[0, 3] = 1  # matrix must be writable
+        partSet.close()
+
+
+class TestSetArrays(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_getSetArrays(self):
+        """ Check reading and updating item attributes as numpy arrays. """
+        fn = self.getOutputPath('particles_arrays.sqlite')
+        partSet = emobj.SetOfParticles(filename=fn)
+        self.assertEqual(len(partSet.getArrays(['id'])['id']), 0)
+        n = 100
+
+        for i in range(n):
+            p = emobj.Particle(location=(i + 1, 'particles.mrcs'))
+            ctf = emobj.CTFModel()
+            ctf.setStandardDefocus(10000 + i, 9000 + i, 45)
+            p.setCTF(ctf)
+            p.setTransform(emobj.Transform(np.eye(4) * (i + 1)))
+            partSet.append(p)
+        partSet.write()
+        partSet.close()
+
+        partSet = emobj.SetOfParticles(filename=fn)
+        arrays = partSet.getArrays(['id', '_ctfModel._defocusU',
+                                    '_transform._matrix'],
+                                   where='_ctfModel._defocusU>=10050',
+                                   direction='DESC')
+        ids = arrays['id']
+        self.assertEqual(ids.tolist(), list(range(n, 50, -1)))
+        self.assertTrue(np.allclose(arrays['_ctfModel._defocusU'], ids + 9999))
+        matrices = arrays['_transform._matrix']
+        self.assertEqual(matrices.shape, (50, 4, 4))
+        self.assertTrue(np.allclose(matrices[:, 0, 0], ids))
+
+        matrices[:, 0, 3] = ids
+        partSet.setArrays(ids, {'_transform._matrix': matrices,
+                                '_ctfModel._defocusU': np.zeros(len(ids))})
+        partSet.write()
+        partSet.close()
+
+        partSet = emobj.SetOfParticles(filename=fn)
+        for p in partSet:
+            i = p.getObjId()
+            updated = i > 50
+            self.assertEqual(p.getCTF().getDefocusU(), 0 if updated else 9999 + i)
+            self.assertEqual(p.getTransform().getShifts()[0], i if updated else 0)
+
+        with self.assertRaises(Exception):
+            partSet.getArrays(['_missingAttribute'])
+        partSet.close()
+
+    def test_getSetTransforms(self):
+        """ Check that composing all the transforms at once gives the
+        same result as composing them one by one.
+        """
+        fn = self.getOutputPath('particles_transforms.sqlite')
+        partSet = emobj.SetOfParticles(filename=fn)
+        for i in range(20):
+            p = emobj.Particle(location=(i + 1, 'particles.mrcs'))
+            p.setTransform(emobj.Transform(np.random.rand(4, 4)))
+            partSet.append(p)
+        partSet.write()
+
+        rotation = np.random.rand(4, 4)
+        expected = {}
+        for p in partSet:
+            t = p.getTransform()
+            t.composeTransform(rotation)
+            expected[p.getObjId()] = t.getMatrix()
+
+        ids, matrices = partSet.getTransforms()
+        self.assertEqual(matrices.shape, (20, 4, 4))
+        partSet.setTransforms(ids, np.matmul(rotation, matrices))
+        partSet.write()
+        partSet.close()
+
+        partSet = emobj.SetOfParticles(filename=fn)
+        for p in partSet:
+            self.assertTrue(np.allclose(p.getTransform().getMatrix(),
+                                        expected[p.getObjId()]))
+        partSet.close()
+
 
 class TestCopyItems(BaseTest):
     _labels = [SMALL, WEEKLY]
@@ -968,6 +1516,323 @@ class TestCopyItems(BaseTest):
         item._list.set([1.0, 2.0])
 
 
+class TestBulkCopyItems(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _createParticles(self, fn, n, homogeneous=False):
+        partSet = emobj.SetOfParticles(filename=fn, homogeneous=homogeneous)
+        partSet.setSamplingRate(1.5)
+        for i in range(n):
+            p = emobj.Particle(location=(i + 1, 'particles.mrcs'))
+            ctf = emobj.CTFModel()
+            ctf.setStandardDefocus(10000 + i, 9000, 45)
+            p.setCTF(ctf)
+            p.setTransform(emobj.Transform(np.eye(4) * i))
+            p.setEnabled(i % 10 != 0)
+            partSet.append(p)
+        partSet.write()
+        return partSet
+
+    def _copy(self, inputSet, name, **kwargs):
+        fn = self.getOutputPath(name)
+        pwutils.cleanPath(fn)
+        outputSet = emobj.SetOfParticles(filename=fn)
+        outputSet.copyInfo(inputSet)
+        outputSet.copyItems(inputSet, **kwargs)
+        outputSet.write()
+        self.assertEqual(outputSet.getSize(), len(outputSet))
+        rows = [(p.getObjId(), p.isEnabled(), p.getSamplingRate(),
+                 p.getCTF().getDefocusU(), p.getTransform().getMatrix().sum())
+                for p in outputSet]
+        outputSet.close()
+        return rows
+
+    def test_copyItems(self):
+        """ Check that bulk copies (INSERT ... SELECT and batched inserts)
+        give the same result as copying the items one by one.
+        """
+        inputSet = self._createParticles(
+            self.getOutputPath('particles_input.sqlite'), 55)
+
+        # Repeated and missing ids are ignored
+        itemIds = list(np.arange(1, 70, 3)) + [4, 7]
+        for kwargs in [{}, {'copyDisabled': True},
+                       {'copyDisabled': True, 'doClone': False},
+                       {'itemIds': itemIds},
+                       {'copyDisabled': True, 'doClone': False,
+                        'itemIds': itemIds}]:
+            expected = self._copy(inputSet, 'particles_slow.sqlite',
+                                  batchSize=0, **kwargs)
+            rows = self._copy(inputSet, 'particles_fast.sqlite', **kwargs)
+            self.assertEqual(rows, expected)
+            rows = self._copy(inputSet, 'particles_batch.sqlite', batchSize=7,
+                              updateItemCallback=lambda item, row: None,
+                              **kwargs)
+            self.assertEqual(rows, expected)
+
+        self.assertEqual(len(self._copy(inputSet, 'particles_slow.sqlite',
+                                        batchSize=0)), 49)
+        self.assertEqual([row[0] for row in self._copy(
+            inputSet, 'particles_fast.sqlite', copyDisabled=True,
+            itemIds=itemIds)], list(range(1, 56, 3)))
+
+    def test_copyRowsById(self):
+        """ Check the intersection and difference of sets done in sqlite. """
+        fullSet = self._createParticles(
+            self.getOutputPath('particles_full.sqlite'), 30)
+        subSet = emobj.SetOfParticles(
+            filename=self.getOutputPath('particles_sub.sqlite'))
+        for i in range(1, 40, 3):
+            p = emobj.Particle(location=(i, 'other.mrcs'))
+            p.setObjId(i)
+            subSet.append(p)
+        subSet.write()
+
+        fullIds, subIds = fullSet.getIdSet(), subSet.getIdSet()
+        # The ids can also be given as a list
+        for idSet, difference, expected in [
+                (subSet, False, fullIds & subIds),
+                (subSet, True, fullIds - subIds),
+                (sorted(subIds), False, fullIds & subIds),
+                (sorted(subIds), True, fullIds - subIds)]:
+            fn = self.getOutputPath('particles_join.sqlite')
+            pwutils.cleanPath(fn)
+            outputSet = emobj.SetOfParticles(filename=fn)
+            outputSet.copyInfo(fullSet)
+            self.assertTrue(outputSet.copyRowsById(fullSet, idSet,
+                                                   difference=difference))
+            outputSet.write()
+            self.assertEqual(outputSet.getSize(), len(expected))
+            self.assertEqual(outputSet.getIdSet(), expected)
+            for p in outputSet:
+                # Items are not cloned, so the enabled flag is kept
+                self.assertEqual(p.isEnabled(), (p.getObjId() - 1) % 10 != 0)
+                self.assertEqual(p.getFileName(), 'particles.mrcs')
+            outputSet.close()
+
+    def test_appendRows(self):
+        """ Check the union of sets done in sqlite. """
+        set1 = self._createParticles(
+            self.getOutputPath('particles_union1.sqlite'), 20)
+        set2 = self._createParticles(
+            self.getOutputPath('particles_union2.sqlite'), 30)
+
+        def _union(name, *args, **kwargs):
+            fn = self.getOutputPath(name)
+            pwutils.cleanPath(fn)
+            outputSet = emobj.SetOfParticles(filename=fn)
+            outputSet.copyInfo(set1)
+            self.assertTrue(outputSet.appendRows(set1, **kwargs))
+            for otherSet in args:
+                self.assertTrue(outputSet.appendRows(otherSet, **kwargs))
+            outputSet.write()
+            return outputSet
+
+        outputSet = _union('particles_union.sqlite', set2, newIds=True)
+        self.assertEqual(outputSet.getSize(), 50)
+        self.assertEqual(outputSet.getIdSet(), set(range(1, 51)))
+        self.assertEqual(outputSet[45].getCTF().getDefocusU(),
+                         set2[25].getCTF().getDefocusU())
+        self.assertEqual(outputSet[41].isEnabled(), set2[21].isEnabled())
+        outputSet.close()
+
+        # The rows of a homogeneous set do not store the sampling rate,
+        # it is taken from the set for the rows that store it
+        set3 = self._createParticles(
+            self.getOutputPath('particles_union3.sqlite'), 10, homogeneous=True)
+        outputSet = _union('particles_union.sqlite', set3, newIds=True)
+        self.assertEqual([p.getSamplingRate() for p in outputSet], [1.5] * 30)
+        outputSet.close()
+
+        # also when it is opened from its file, but not if it has no
+        # sampling rate to fill the rows that store it
+        set3.close()
+        set3 = emobj.SetOfParticles(filename=set3.getFileName())
+        outputSet = _union('particles_union.sqlite', set3, newIds=True)
+        self.assertEqual([p.getSamplingRate() for p in outputSet], [1.5] * 30)
+        outputSet.close()
+        set3.close()
+        set4 = self._createParticles(
+            self.getOutputPath('particles_union4.sqlite'), 10, homogeneous=True)
+        set4.setSamplingRate(None)
+        set4.write()
+        set4.close()
+        set4 = emobj.SetOfParticles(filename=set4.getFileName())
+        fn = self.getOutputPath('particles_union_none.sqlite')
+        outputSet = emobj.SetOfParticles(filename=fn)
+        p = emobj.Particle(location=(1, 'particles.mrcs'))
+        outputSet.append(p)
+        self.assertFalse(outputSet.appendRows(set4, newIds=True))
+        outputSet.close()
+
+        outputSet = _union('particles_union.sqlite', set2, skipDuplicates=True)
+        self.assertEqual(outputSet.getSize(), 30)
+        self.assertEqual(outputSet.getIdSet(), set(range(1, 31)))
+        outputSet.close()
+
+        # Only the new items are appended in incremental mode
+        outputSet = _union('particles_union.sqlite', incremental=True)
+        self.assertEqual(outputSet.getSize(), 20)
+        for i in range(5):
+            p = set1.getFirstItem().clone()
+            p.cleanObjId()
+            p.setLocation(i + 1, 'new.mrcs')
+            set1.append(p)
+        set1.write()
+        for _ in range(2):
+            self.assertTrue(outputSet.appendRows(set1, incremental=True))
+            outputSet.write()
+            self.assertEqual(outputSet.getSize(), 25)
+        self.assertEqual([p.getFileName() for p in outputSet].count('new.mrcs'), 5)
+        outputSet.close()
+
+
+    def test_copyRowsByKey(self):
+        """ Check the CTF assignment joined in sqlite against setting the
+        CTF of each item.
+        """
+        inputSet = self._createParticles(
+            self.getOutputPath('particles_keys.sqlite'), 40)
+        ctfDict = {}
+        for micId in range(1, 5):
+            ctf = emobj.CTFModel()
+            ctf.setStandardDefocus(20000 + micId, 19000, 10)
+            ctf.setMicrograph(emobj.Micrograph(location='mic%d.mrc' % micId))
+            ctfDict[micId] = ctf
+
+        def _micId(p):
+            return p.getObjId() % 5
+
+        expected = []
+        for p in inputSet:
+            if _micId(p) in ctfDict:
+                expected.append((p.getObjId(), True,
+                                 ctfDict[_micId(p)].getDefocusU(),
+                                 ctfDict[_micId(p)].getMicrograph().getFileName(),
+                                 p.getTransform().getMatrix().sum()))
+
+        inputSet.close()
+        # Use the id to define the micrograph of each particle
+        db = inputSet._getMapper().db
+        db.executeCommand("UPDATE %sObjects SET %s=id %% 5"
+                          % (db.tablePrefix, db._columnsMapping['_micId']))
+        db.commit()
+
+        fn = self.getOutputPath('particles_ctf.sqlite')
+        pwutils.cleanPath(fn)
+        outputSet = emobj.SetOfParticles(filename=fn)
+        outputSet.copyInfo(inputSet)
+        self.assertTrue(outputSet.copyRowsByKey(inputSet, '_micId',
+                                                '_ctfModel', ctfDict))
+        outputSet.write()
+        self.assertEqual(outputSet.getSize(), len(expected))
+        self.assertEqual([(p.getObjId(), p.isEnabled(), p.getCTF().getDefocusU(),
+                           p.getCTF().getMicrograph().getFileName(),
+                           p.getTransform().getMatrix().sum())
+                          for p in outputSet], expected)
+        outputSet.close()
+
+
+    def test_classifyItems(self):
+        """ Check that the items classified in batches are the same as
+        appending them one by one.
+        """
+        inputSet = self._createParticles(
+            self.getOutputPath('particles_classify.sqlite'), 50)
+
+        def _setClassId(item, row):
+            item.setClassId(item.getObjId() % 4 + 1)
+            item._appendItem = item.getObjId() % 7 != 0
+
+        results = []
+        for batchSize in [0, 6]:
+            fn = self.getOutputPath('classes2d.sqlite')
+            pwutils.cleanPath(fn)
+            classes2D = emobj.SetOfClasses2D(filename=fn)
+            classes2D.setImages(inputSet)
+            classes2D.classifyItems(updateItemCallback=_setClassId,
+                                    batchSize=batchSize)
+            classes2D.write()
+            classes2D.close()
+
+            classes2D = emobj.SetOfClasses2D(filename=fn)
+            results.append([(cls.getObjId(), cls.getSize(),
+                             [(p.getObjId(), p.getClassId(),
+                               p.getCTF().getDefocusU()) for p in cls])
+                            for cls in classes2D])
+            classes2D.close()
+
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(sum(size for _, size, _ in results[1]), 39)
+
+
+class TestHomogeneousSet(BaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_homogeneous(self):
+        """ Check that sampling rate and acquisition are not stored per
+        image but are still set to the images when reading the set.
+        """
+        fn = self.getOutputPath('particles_homogeneous.sqlite')
+        partSet = emobj.SetOfParticles(filename=fn, homogeneous=True)
+        partSet.setSamplingRate(1.25)
+        partSet.setAcquisition(emobj.Acquisition(magnification=50000,
+                                                 voltage=300,
+                                                 sphericalAberration=2.7,
+                                                 amplitudeContrast=0.1))
+        for i in range(10):
+            p = emobj.Particle(location=(i + 1, 'particles.mrcs'))
+            p.setSamplingRate(3.0)
+            partSet.append(p)
+            self.assertEqual(p.getSamplingRate(), 3.0)
+        partSet.write()
+        partSet.close()
+
+        # Opened from the file, the set properties are loaded on demand
+        partSet = emobj.SetOfParticles(filename=fn)
+        self.assertNotIn('_samplingRate', partSet._getColumnClasses())
+        self.assertNotIn('_acquisition._voltage', partSet._getColumnClasses())
+        items = [(p.getSamplingRate(), p.getAcquisition().getVoltage())
+                 for p in partSet]
+        self.assertEqual(items, [(1.25, 300.0)] * 10)
+        self.assertTrue(partSet.isHomogeneous())
+        self.assertEqual(partSet[3].getSamplingRate(), 1.25)
+
+        copySet = emobj.SetOfParticles(
+            filename=self.getOutputPath('particles_copy.sqlite'))
+        copySet.copyInfo(partSet)
+        copySet.copyItems(partSet)
+        self.assertEqual(copySet.getFirstItem().getSamplingRate(), 1.25)
+        copySet.close()
+        partSet.close()
+
+    def test_reopenFromFile(self):
+        """ Single items of a homogeneous set reopened from its file (not
+        iterated first) also get the set sampling rate and acquisition.
+        """
+        fn = self.getOutputPath('particles_homogeneous_reopen.sqlite')
+        partSet = emobj.SetOfParticles(filename=fn, homogeneous=True)
+        partSet.setSamplingRate(2.5)
+        partSet.setAcquisition(emobj.Acquisition(voltage=200))
+        for i in range(5):
+            partSet.append(emobj.Particle(location=(i + 1, 'particles.mrcs')))
+        partSet.write()
+        partSet.close()
+
+        for getItem in [lambda s: s.getFirstItem(), lambda s: s[3]]:
+            partSet = emobj.SetOfParticles(filename=fn)
+            part = getItem(partSet)
+            self.assertEqual(part.getSamplingRate(), 2.5)
+            self.assertEqual(part.getAcquisition().getVoltage(), 200)
+            partSet.close()
+
+
 class TestCoordinatesTiltPair(BaseTest):
     # TODO: A proper test for CoordinatesTiltPair is missing
     @classmethod
@@ -1,5 +1,11 @@
+import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import Mock, patch, MagicMock
+import numpy as np
+
+from pwem.objects import SetOfCoordinates, Coordinate, Micrograph
 from pwem.protocols.protocol_particles import ProtExtractParticles
 from pwem.tests.utils import getSoCTFsMock, getSoMMock
 
@@ -188,3 +194,51 @@ class TestExtractParticles(unittest.TestCase):
             extractParticles.micDict = processedMics
 
             return extractParticles._loadInputList()
+
+
+class TestLoadInputCoords(unittest.TestCase):
+    """ Checks the coordinates read per micrograph in a single query against
+    querying the set once per micrograph. """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_loadInputCoords(self):
+        coordsFn = os.path.join(self.tmpDir, 'coordinates.sqlite')
+        coordSet = SetOfCoordinates(filename=coordsFn)
+        coordSet.setBoxSize(10)
+        rng = np.random.default_rng(5)
+        # Mic 2 has no coordinates and mic 4 is not requested
+        for micId in rng.choice([1, 3, 4, 5], 100):
+            coord = Coordinate()
+            coord.setPosition(*rng.integers(0, 1000, 2))
+            coord.setMicId(int(micId))
+            coordSet.append(coord)
+        coordSet.write()
+        coordSet.close()
+
+        micDict = {}
+        for micId in [1, 2, 3, 5]:
+            mic = Micrograph(location='mic_%06d.mrc' % micId)
+            mic.setObjId(micId)
+            micDict[micId] = mic
+
+        prot = ProtExtractParticles()
+        prot.getCoords = lambda: coordSet
+        prot.coordDict = {}
+        micList = prot._loadInputCoords(micDict)
+
+        self.assertEqual(sorted(m.getObjId() for m in micList.values()),
+                         [1, 3, 5])
+        self.assertEqual(sorted(prot.coordDict), [1, 3, 5])
+
+        coordSet = SetOfCoordinates(filename=coordsFn)
+        for micId, coords in prot.coordDict.items():
+            expected = [(c.getObjId(), c.getPosition())
+                        for c in coordSet.iterItems(where='_micId=%s' % micId)]
+            self.assertEqual([(c.getObjId(), c.getPosition()) for c in coords],
+                             expected)
+        coordSet.close()
@@ -27,7 +27,8 @@ import os
 
 from pyworkflow.tests import BaseTest, setupTestProject
 from pyworkflow.utils import runJob
-from xmipp3 import Plugin
+import pwem.constants as emcts
+import pwem.objects as emobj
 import pwem.protocols as emprot
 
 
@@ -104,6 +105,7 @@ _noisePixelLevel   '0. 0.'
 
 
 def projectPhantom(featFileName, paramFileName, particlesFileName):
+    from xmipp3 import Plugin
     args = "-i %s -o %s" % (featFileName, particlesFileName)
     args += " --params %s" % paramFileName
     runJob(None, "xmipp_phantom_project", args, env=Plugin.getEnviron())
@@ -168,3 +170,69 @@ class TestProtAssignAngles(BaseTest):
             self.assertFalse(result)
         self.assertEqual(len(prot3.outputParticles),
                          len(prot1.outputParticles))
+
+
+class TestProtAlignmentAssign(BaseTest):
+    """ Assign the alignment of synthetic particles, without any image. """
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+
+    def _createParticles(self, dummyProt, suffix, samplingRate, ids,
+                         aligned):
+        partSet = dummyProt._createSetOfParticles(suffix=suffix)
+        partSet.setSamplingRate(samplingRate)
+        if aligned:
+            partSet.setAlignment(emcts.ALIGN_2D)
+        for partId in ids:
+            part = emobj.Particle(location=(partId, 'particles.mrcs'))
+            part.setObjId(partId)
+            if aligned:
+                matrix = np.eye(4)
+                matrix[0, 0] = matrix[1, 1] = np.cos(partId)
+                matrix[0, 1] = -np.sin(partId)
+                matrix[1, 0] = np.sin(partId)
+                matrix[:3, 3] = [partId, -partId, 0]
+                part.setTransform(emobj.Transform(matrix))
+                part._rlnRandomSubset = emobj.Integer(partId % 2 + 1)
+            partSet.append(part)
+        partSet.write()
+        return partSet
+
+    def test_assignSynthetic(self):
+        dummyProt = self.newProtocol(emprot.EMProtocol)
+        dummyProt.setObjLabel('dummy protocol')
+        self.launchProtocol(dummyProt)
+
+        # Alignment for a subset of the particles, at double pixel size
+        alignedIds = [2, 3, 5, 8, 13, 21, 34]
+        inputParts = self._createParticles(dummyProt, 'input', 1.0,
+                                           range(1, 41), aligned=False)
+        alignParts = self._createParticles(dummyProt, 'align', 2.0,
+                                           alignedIds + [50], aligned=True)
+        dummyProt._defineOutputs(inputParticles=inputParts,
+                                 alignParticles=alignParts)
+        dummyProt._store()
+
+        protAssign = self.newProtocol(emprot.ProtAlignmentAssign)
+        protAssign.inputParticles.set(dummyProt)
+        protAssign.inputParticles.setExtended('inputParticles')
+        protAssign.inputAlignment.set(dummyProt)
+        protAssign.inputAlignment.setExtended('alignParticles')
+        self.launchProtocol(protAssign)
+
+        outputParts = protAssign.outputParticles
+        self.assertEqual(outputParts.getAlignment(), emcts.ALIGN_2D)
+        self.assertEqual([p.getObjId() for p in outputParts], alignedIds)
+
+        alignments = {p.getObjId(): p.getTransform().getMatrix()
+                      for p in alignParts}
+        for part in outputParts:
+            expected = np.copy(alignments[part.getObjId()])
+            expected[:3, 3] *= 2  # shifts scaled to the input pixel size
+            self.assertTrue(np.allclose(part.getTransform().getMatrix(),
+                                        expected))
+            self.assertEqual(part._rlnRandomSubset.get(),
+                             part.getObjId() % 2 + 1)
+
+        self.assertTrue(protAssign.summary())
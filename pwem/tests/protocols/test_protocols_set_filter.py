@@ -176,4 +176,66 @@ class TestSetFilter(pwtests.BaseTest):
         protSetFilter.threshold.set(threshold)
         protSetFilter.rankingField.set('_x')
         self.launchProtocol(protSetFilter)
-        self.assertSetSize(protSetFilter.outputCoordinates, expectedSize)
\ No newline at end of file
+        self.assertSetSize(protSetFilter.outputCoordinates, expectedSize)
+
+    def testDistanceBruteForce(self):
+        """Compare the distance filter with all the pairs of coordinates,
+        including an empty micrograph and coordinates at the distance"""
+        dummyProt = self.newProtocol(EMProtocol)
+        dummyProt.setObjLabel('dummy protocol distance')
+        self.launchProtocol(dummyProt)
+
+        micSet = dummyProt._createSetOfMicrographs()
+        for i in range(1, 4):
+            mic = emobj.Micrograph(location="mic_%06d.mrc" % i)
+            mic.setSamplingRate(2.)
+            micSet.append(mic)
+        micSet.setSamplingRate(2.)
+        micSet.write()
+
+        # distance of 20 A is 10 px, micrograph 2 has no coordinates
+        points = [(20, 20, 1), (30, 20, 1), (20, 30, 1),  # exactly at 10 px
+                  (50, 50, 1), (56, 57, 1), (100, 100, 3)]
+        rng = np.random.default_rng(7)
+        for x, y in rng.integers(40, 150, (200, 2)):
+            points.append((x, y, rng.choice([1, 3])))
+
+        coordSet = dummyProt._createSetOfCoordinates(micSet)
+        coordSet.setBoxSize(10)
+        coord = emobj.Coordinate()
+        for x, y, micId in points:
+            coord.setPosition(int(x), int(y))
+            coord.setMicId(int(micId))
+            coordSet.append(coord)
+            coord.cleanObjId()
+        coordSet.write()
+        dummyProt._defineOutputs(**{OUTPUT_COORDINATES: coordSet,
+                                    'outputMic': micSet})
+        dummyProt._store()
+
+        coords = [(c.getObjId(), c.getX(), c.getY(), c.getMicId())
+                  for c in coordSet]
+        for keepFirst in [True, False]:
+            keep = {c[0]: True for c in coords}
+            for i, (id1, x1, y1, mic1) in enumerate(coords):
+                for id2, x2, y2, mic2 in coords[i + 1:]:
+                    if mic1 == mic2 and (x1 - x2) ** 2 + (y1 - y2) ** 2 < 100:
+                        keep[id1] = keep[id1] and keepFirst
+                        keep[id2] = False
+
+            protSetFilter = self.newProtocol(
+                ProtSetFilter, objLabel="distance brute force %s" % keepFirst)
+            protSetFilter.inputSet.set(dummyProt)
+            protSetFilter.inputSet.setExtended(OUTPUT_COORDINATES)
+            protSetFilter.operation.set(
+                protSetFilter.CHOICE_DISTANCE_BETWEEN_COORDS)
+            protSetFilter.distance.set(20)
+            protSetFilter.keepFirst.set(keepFirst)
+            self.launchProtocol(protSetFilter)
+
+            output = protSetFilter.outputCoordinates
+            self.assertEqual([c.getObjId() for c in output],
+                             sorted(k for k, v in keep.items() if v))
+            # Coordinates exactly at the distance are not close
+            self.assertTrue(keep[1] and keep[2] and keep[3])
+            self.assertFalse(keep[5])
@@ -32,6 +32,8 @@ logger = logging.getLogger(__name__)
 import random
 import unittest
 
+import numpy as np
+
 from pwem.protocols import ProtUserSubSet
 from pyworkflow.tests import DataSet
 
@@ -660,6 +662,173 @@ class TestSets(pwtests.BaseTest):
             self.launchProtocol(p_union)
 
 
+class TestCoordinatesSubsets(pwtests.BaseTest):
+    """ Subsets of synthetic coordinates and particles, without images. """
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestProject(cls)
+
+    def _createDummyProtocol(self, label, micIds, coordsDict,
+                             particlePoints=None):
+        """ Create a protocol with micrographs with micIds and a set of
+        coordinates per each entry of coordsDict: (x, y, micId) list.
+        If particlePoints is passed, also a set of particles with
+        these (x, y, micId) coordinates. """
+        dummyProt = self.newProtocol(emprot.EMProtocol)
+        dummyProt.setObjLabel(label)
+        self.launchProtocol(dummyProt)
+
+        micSet = dummyProt._createSetOfMicrographs()
+        for micId in micIds:
+            mic = emobj.Micrograph(location='mic_%06d.mrc' % micId)
+            mic.setObjId(micId)
+            mic.setSamplingRate(1.)
+            micSet.append(mic)
+        micSet.setSamplingRate(1.)
+        micSet.write()
+        outputs = {'outputMicrographs': micSet}
+
+        for name, points in coordsDict.items():
+            coordSet = dummyProt._createSetOfCoordinates(micSet, suffix=name)
+            coordSet.setBoxSize(10)
+            for x, y, micId in points:
+                coord = emobj.Coordinate()
+                coord.setPosition(x, y)
+                coord.setMicId(micId)
+                coordSet.append(coord)
+            coordSet.write()
+            outputs[name] = coordSet
+
+        if particlePoints is not None:
+            partSet = dummyProt._createSetOfParticles()
+            partSet.setSamplingRate(1.)
+            for i, (x, y, micId) in enumerate(particlePoints):
+                part = emobj.Particle(location=(i + 1, 'particles.mrcs'))
+                coord = emobj.Coordinate()
+                coord.setPosition(x, y)
+                coord.setMicId(micId)
+                part.setCoordinate(coord)
+                part.setMicId(micId)
+                partSet.append(part)
+            partSet.write()
+            outputs['outputParticles'] = partSet
+
+        dummyProt._defineOutputs(**outputs)
+        dummyProt._store()
+        return dummyProt
+
+    def testPickingDifference(self):
+        """ Coordinates closer than the radius (euclidean distance) to a
+        negative coordinate of the same micrograph are removed. """
+        inputPoints = [
+            (100, 100, 1),  # 1: at the same position, removed
+            (110, 100, 1),  # 2: exactly at the radius, kept
+            (106, 108, 1),  # 3: exactly at the radius, kept
+            (107, 107, 1),  # 4: at 9.9 px, removed
+            (150, 100, 1),  # 5: same row at 50 px, kept
+            (111, 101, 1),  # 6: at 11.05 px (|dx * dy| < r^2), kept
+            (100, 100, 2),  # 7: no negative coordinates in mic 2, kept
+            (100, 100, 4),  # 8: mic 4 is not in the input micrographs
+        ]
+        negativePoints = [(100, 100, 1), (300, 300, 1), (110, 100, 3)]
+        dummyProt = self._createDummyProtocol(
+            'dummy picking difference', [1, 2, 3],
+            {'inputCoords': inputPoints, 'negativeCoords': negativePoints})
+
+        protDiff = self.newProtocol(emprot.ProtPickingDifference,
+                                    differenceRadius=10)
+        protDiff.inputCoordinates.set(dummyProt)
+        protDiff.inputCoordinates.setExtended('inputCoords')
+        protDiff.negativeCoordinates.set(dummyProt)
+        protDiff.negativeCoordinates.setExtended('negativeCoords')
+        self.launchProtocol(protDiff)
+
+        self.assertEqual([c.getObjId() for c in protDiff.outputCoordinates],
+                         [2, 3, 5, 6, 7])
+        self.assertEqual(protDiff.outputCoordinates.getBoxSize(), 10)
+
+    def testSubsetByCoordBruteForce(self):
+        """ Compare the particles matched to coordinates with a check of
+        all the coordinates of their micrograph. """
+        coordPoints = [(100, 100, 1), (200, 200, 1), (50, 50, 3)]
+        partPoints = [
+            (102, 98, 1),   # 1: x and y exactly at the tolerance
+            (102, 97, 1),   # 2: y beyond the tolerance
+            (201, 200, 1),  # 3: within the tolerance
+            (100, 100, 2),  # 4: micrograph 2 has no coordinates
+            (50, 50, 3),    # 5: same position
+        ]
+        rng = np.random.default_rng(3)
+        for _ in range(200):
+            x, y = rng.integers(0, 100, 2)
+            coordPoints.append((x, y, rng.choice([1, 3, 4])))
+            x, y = rng.integers(0, 100, 2)
+            partPoints.append((x, y, rng.choice([1, 2, 3, 4])))
+        dummyProt = self._createDummyProtocol(
+            'dummy subset by coord', [1, 2, 3, 4], {'coords': coordPoints},
+            particlePoints=partPoints)
+
+        for tolerance in [0, 2]:
+            expected = [i + 1 for i, (x0, y0, mic0) in enumerate(partPoints)
+                        if any(mic == mic0 and abs(x - x0) <= tolerance and
+                               abs(y - y0) <= tolerance
+                               for x, y, mic in coordPoints)]
+            protSubset = self.newProtocol(emprot.ProtSubSetByCoord,
+                                          coordTolerance=tolerance)
+            protSubset.inputParticles.set(dummyProt)
+            protSubset.inputParticles.setExtended('outputParticles')
+            protSubset.inputCoordinates.set(dummyProt)
+            protSubset.inputCoordinates.setExtended('coords')
+            self.launchProtocol(protSubset)
+
+            output = [p.getObjId() for p in protSubset.outputParticles]
+            self.assertEqual(output, expected)
+            self.assertEqual(1 in output, tolerance == 2)
+            self.assertNotIn(2, output)
+            self.assertNotIn(4, output)
+
+
+class TestUnionRows(pwtests.BaseTest):
+    """ Union of synthetic sets, whose rows are appended in sqlite. """
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestProject(cls)
+
+    def testUnionHomogeneous(self):
+        """ The rows of a homogeneous set do not store the sampling rate
+        nor the acquisition, but they are kept in the union. """
+        dummyProt = self.newProtocol(emprot.EMProtocol)
+        dummyProt.setObjLabel('dummy particles')
+        self.launchProtocol(dummyProt)
+
+        outputs = {}
+        for suffix, homogeneous in [('normal', False), ('homogeneous', True)]:
+            partSet = dummyProt._createSetOfParticles(suffix=suffix)
+            partSet.setHomogeneous(homogeneous)
+            partSet.setSamplingRate(1.5)
+            partSet.setAcquisition(Acquisition(voltage=300,
+                                               sphericalAberration=2.7,
+                                               amplitudeContrast=0.1,
+                                               magnification=50000))
+            for i in range(3):
+                partSet.append(Particle(location=(i + 1, 'particles.mrcs')))
+            partSet.write()
+            outputs['outputParticles_%s' % suffix] = partSet
+        dummyProt._defineOutputs(**outputs)
+        dummyProt._store()
+
+        p_union = self.newProtocol(emprot.ProtUnionSet,
+                                   objLabel='union homogeneous')
+        for name in sorted(outputs, reverse=True):
+            p_union.inputSets.append(getattr(dummyProt, name))
+        self.launchProtocol(p_union)
+
+        items = [(p.getObjId(), p.getSamplingRate(),
+                  p.getAcquisition().getVoltage())
+                 for p in p_union.outputSet]
+        self.assertEqual(items, [(i, 1.5, 300.) for i in range(1, 7)])
+
+
 class TestUserSubSet(pwtests.BaseTest):
     @classmethod
     def setUpClass(cls):